@@ -0,0 +1,154 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from confluence_http import retry_get
+
+BUFFER_SIZE = 1024 * 1024  # крупный буфер: вложения бывают по сотням МБ
+MAX_RESUMES = 5  # сколько раз докачивать после обрыва посреди передачи
+
+
+class IncompleteDownload(requests.RequestException):
+    """Размер скачанного не совпал с fileSize из метаданных вложения."""
+
+
+def part_path(dest, version=None):
+    """Имя недокачанного файла: с версией вложения, чтобы не продолжить байтами другой версии."""
+    return f"{dest}.v{version}.part" if version is not None else dest + ".part"
+
+
+def download_file(session, url, dest, expected_size=None, version=None):
+    """Скачивает url в dest через .part и атомарное переименование.
+
+    Недокачанный .part (от упавшего запуска или оборвавшейся передачи)
+    продолжается запросом с Range. Версия вложения входит в имя .part, так
+    что после загрузки новой версии старый обрывок не продолжается; внутри
+    запуска Range идёт с If-Range (ETag/Last-Modified прошлого ответа), и
+    если файл на сервере сменился, он приходит целиком. Если известен
+    expected_size (fileSize из метаданных), итоговый размер сверяется с ним.
+    Возвращает число байт, полученных по сети, или None, если файла нет (404).
+    """
+    part = part_path(dest, version)
+    if version is not None and os.path.exists(dest + ".part"):
+        os.remove(dest + ".part")  # обрывок без версии — неизвестно, от какой он версии
+    validator = None  # ETag или Last-Modified ответа, байты которого лежат в part
+    for attempt in range(MAX_RESUMES):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if expected_size is not None and offset > expected_size:
+            os.remove(part)
+            offset = 0
+        if expected_size is not None and offset == expected_size and offset:
+            os.replace(part, dest)
+            return 0
+
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        if offset and validator:
+            headers["If-Range"] = validator
+        try:
+            resp = retry_get(session, url, stream=True, headers=headers)
+        except requests.HTTPError as e:
+            if offset and e.response is not None and e.response.status_code == 416:
+                os.remove(part)  # сервер не принял Range — начинаем заново
+                continue
+            raise
+        if resp is None:
+            return None
+        if offset and resp.status_code != 206:
+            offset = 0  # Range не поддержан или файл сменился (If-Range) — пришёл файл целиком
+        validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+
+        received = 0
+        try:
+            with open(part, "ab" if offset else "wb") as f:
+                for chunk in resp.iter_content(BUFFER_SIZE):
+                    f.write(chunk)
+                    received += len(chunk)
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            print(f"⚠️ Обрыв при скачивании {url} ({e.__class__.__name__}), докачиваем")
+            continue
+        finally:
+            resp.close()
+
+        size = offset + received
+        if expected_size is not None and size < expected_size:
+            print(f"⚠️ Получено {size} из {expected_size} байт {url}, докачиваем")
+            continue
+        if expected_size is not None and size != expected_size:
+            os.remove(part)
+            raise IncompleteDownload(f"{url}: получено {size} байт, ожидалось {expected_size}")
+        os.replace(part, dest)
+        return received
+    raise IncompleteDownload(f"{url}: не удалось докачать за {MAX_RESUMES} попыток")
+
+
+def stream_file(session, url, out, expected_size=None):
+    """Скачивает url в открытый на запись файловый объект out (например, файл в архиве).
+
+    Обрыв посреди передачи докачивается запросом с Range (и If-Range) с уже
+    записанного места. Возвращает число полученных байт или None, если файла нет (404).
+    """
+    validator = None
+    for attempt in range(MAX_RESUMES):
+        offset = out.tell()
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        if offset and validator:
+            headers["If-Range"] = validator
+        resp = retry_get(session, url, stream=True, headers=headers)
+        if resp is None:
+            return None
+        try:
+            if offset and resp.status_code != 206:
+                out.seek(0)  # Range не поддержан или файл сменился (If-Range) — пришёл файл целиком
+                out.truncate()
+            validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+            for chunk in resp.iter_content(BUFFER_SIZE):
+                out.write(chunk)
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            print(f"⚠️ Обрыв при скачивании {url} ({e.__class__.__name__}), докачиваем")
+            continue
+        finally:
+            resp.close()
+        size = out.tell()
+        if expected_size is not None and size < expected_size:
+            print(f"⚠️ Получено {size} из {expected_size} байт {url}, докачиваем")
+            continue
+        if expected_size is not None and size != expected_size:
+            raise IncompleteDownload(f"{url}: получено {size} байт, ожидалось {expected_size}")
+        return size
+    raise IncompleteDownload(f"{url}: не удалось докачать за {MAX_RESUMES} попыток")
+
+
+def attachment_size(att):
+    """fileSize из метаданных вложения Confluence (None, если сервер его не отдал)."""
+    return att.get("extensions", {}).get("fileSize")
+
+
+class TransferPool:
+    """Пул параллельных скачиваний со своей сессией на каждый поток."""
+
+    def __init__(self, make_session, workers):
+        self.make_session = make_session
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = self.make_session()
+        return self.local.session
+
+    def run(self, jobs):
+        """Выполняет jobs (функции от сессии) параллельно и ждёт все; первая ошибка пробрасывается."""
+        futures = [self.pool.submit(lambda job=job: job(self.session())) for job in jobs]
+        error = None
+        for fut in futures:
+            try:
+                fut.result()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def shutdown(self):
+        self.pool.shutdown()
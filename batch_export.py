@@ -0,0 +1,211 @@
+"""Пакетная выгрузка: много пространств и корней за один запуск.
+
+Все пространства и корни работают через одну сессию с общим пулом
+соединений (TLS с клиентским сертификатом поднимается один раз на
+соединение, а не на процесс) и общий ограничитель запросов
+confluence_http. Пространства выгружаются по очереди, каждое в свой
+каталог <output_dir>/<ключ>/export, со своими аргументами new_way_saver_5.py.
+Сначала снимаются лёгкие листинги всех пространств, поэтому ссылки на
+страницы других пространств пакета (?pageId= и /display/КЛЮЧ/Заголовок)
+ведут в их локальные копии. Корни выгружаются wiki_saver.py в
+<output_dir>/roots/<имя>.
+
+Конфиг — JSON:
+{
+  "base_url": "https://sberworks.ru/wiki",
+  "output_dir": "nightly",
+  "max_rps": 50, "max_concurrency": 16, "pool_size": 32,
+  "http_cache": "nightly/.http_cache", "http_cache_mb": 2048, "offline": false,
+  "defaults": ["--workers", "8", "--menu", "external", "--incremental"],
+  "spaces": [{"key": "ISE"}, {"key": "DOC", "args": ["--search-index"]}],
+  "roots": [{"id": "123456", "name": "handbook", "args": ["--workers", "8"]}]
+}
+
+запуск: python batch_export.py nightly.json [--only ISE DOC] [--metrics-prom batch.prom]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import new_way_saver_5 as space_saver
+import wiki_saver
+from confluence_http import configure_limiter
+from response_cache import close_cache, configure_cache
+from export_metrics import METRICS, add_metrics_args, report
+
+
+def load_config(path):
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    config.setdefault("output_dir", "batch_export")
+    config.setdefault("defaults", [])
+    config.setdefault("spaces", [])
+    config.setdefault("roots", [])
+    return config
+
+
+def shared_session(pool_size):
+    """Одна сессия на все потоки всех пространств: пул соединений на pool_size соединений к серверу."""
+    session = space_saver.get_session()
+    session.headers.update({"Accept": "application/json"})
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    space_saver.SHARED_SESSION = session
+    wiki_saver.SHARED_SESSION = session
+    return session
+
+
+def request_counts():
+    return {kind: e["count"] for kind, e in METRICS.snapshot()["requests"].items()}
+
+
+def list_spaces(spaces, base_url, output_dir):
+    """Лёгкие листинги всех пространств пакета: {ключ: страницы}."""
+    listings = {}
+    for space in spaces:
+        space_saver.BASE_URL = base_url
+        space_saver.SPACE_KEY = space["key"]
+        try:
+            with METRICS.phase("listing"):
+                listings[space["key"]] = space_saver.get_all_pages(
+                    space_saver.get_session(), None, space["args"].listing_limit, space["args"].listing_workers)
+                # пути страниц — для ссылок из других пространств; карта путей та же, что у run_space
+                allocator = space_saver.path_allocator(space["args"], os.path.join(output_dir, space["key"]))
+                space_saver.page_tree(listings[space["key"]], allocator)
+        except requests.RequestException as e:
+            print(f"⚠️ Не удалось получить список страниц {space['key']}: {e}")
+        else:
+            print(f"{space['key']}: страниц {len(listings[space['key']])}")
+    return listings
+
+
+def cross_space_links(key, listings):
+    """Пути и заголовки страниц остальных пространств — относительно каталога пространства key."""
+    paths = {}
+    titles = {}
+    for other, pages in listings.items():
+        if other == key:
+            continue
+        for page in pages:
+            paths[page.id] = os.path.join("..", other, page.path + ".html")
+            titles[(other, page.title)] = page.id
+    return {"paths": paths, "titles": titles}
+
+
+def run_space(space, base_url, output_dir, listings):
+    key = space["key"]
+    space_dir = os.path.join(output_dir, key)
+    os.makedirs(space_dir, exist_ok=True)
+    space_saver.BASE_URL = base_url
+    space_saver.SPACE_KEY = key
+    space_saver.STATS.update(pages=0, attachments=0, bytes=0, local_render=0, view_fallback=0)
+    space_saver.FALLBACK_REASONS.clear()
+    before = request_counts()
+    started = time.monotonic()
+    result = {"space": key, "pages": len(listings.get(key, [])), "failed": [], "error": None}
+    cwd = os.getcwd()
+    os.chdir(space_dir)  # new_way_saver_5 пишет в export/ текущего каталога
+    try:
+        if key not in listings:
+            raise requests.RequestException("список страниц не получен")
+        failed = space_saver.export_space(space["args"], listings[key], cross_space_links(key, listings))
+        result["failed"] = [{"id": page.id, "title": page.title} for page in failed]
+    except (requests.RequestException, OSError) as e:
+        print(f"⚠️ Пространство {key} не выгружено: {e}")
+        result["error"] = str(e)
+    finally:
+        os.chdir(cwd)
+    after = request_counts()
+    result.update(
+        saved=space_saver.STATS["pages"],
+        attachments=space_saver.STATS["attachments"],
+        attachment_bytes=space_saver.STATS["bytes"],
+        seconds=round(time.monotonic() - started, 1),
+        requests={kind: n - before.get(kind, 0) for kind, n in after.items() if n != before.get(kind, 0)},
+    )
+    with open(os.path.join(space_dir, "report.json"), "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    return result
+
+
+def run_root(root, base_url, output_dir):
+    name = root.get("name", root["id"])
+    args = wiki_saver.parse_args([base_url, root["id"], os.path.join(output_dir, "roots", name)]
+                                 + root.get("args", []))
+    before = request_counts()
+    started = time.monotonic()
+    result = {"root": root["id"], "name": name, "error": None}
+    try:
+        result["saved"] = count_nodes(wiki_saver.export_root(args))
+    except (requests.RequestException, OSError) as e:
+        print(f"⚠️ Корень {root['id']} не выгружен: {e}")
+        result["error"] = str(e)
+    after = request_counts()
+    result.update(
+        seconds=round(time.monotonic() - started, 1),
+        requests={kind: n - before.get(kind, 0) for kind, n in after.items() if n != before.get(kind, 0)},
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "report.json"), "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    return result
+
+
+def count_nodes(node):
+    return 1 + sum(count_nodes(child) for child in node["children"]) if node else 0
+
+
+def print_summary(results):
+    print(f"\n{'пространство/корень':<24} {'страниц':>8} {'упало':>6} {'запросов':>9} {'время, с':>9}  ошибка")
+    for r in results:
+        name = r.get("space") or f"root {r['name']}"
+        pages = r.get("saved", "")
+        failed = len(r.get("failed", []))
+        print(f"{name:<24} {pages:>8} {failed:>6} {sum(r['requests'].values()):>9} {r['seconds']:>9.1f}  "
+              f"{r['error'] or ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная выгрузка пространств и корней Confluence")
+    parser.add_argument("config", help="JSON со списком пространств и корней")
+    parser.add_argument("--only", nargs="+", help="Выгрузить только эти ключи пространств / id корней")
+    add_metrics_args(parser)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    base_url = config.get("base_url", space_saver.BASE_URL)
+    output_dir = os.path.abspath(config["output_dir"])
+    os.makedirs(output_dir, exist_ok=True)
+    spaces = [s for s in config["spaces"] if not args.only or s["key"] in args.only]
+    roots = [r for r in config["roots"] if not args.only or r["id"] in args.only]
+    for space in spaces:
+        space["args"] = space_saver.parse_args(config["defaults"] + space.get("args", []))
+
+    limiter = configure_limiter(argparse.Namespace(max_rps=config.get("max_rps", 50.0),
+                                                   max_concurrency=config.get("max_concurrency", 16)))
+    configure_cache(argparse.Namespace(http_cache=config.get("http_cache"), http_cache_mb=config.get("http_cache_mb", 512),
+                                       offline=config.get("offline", False)))
+    shared_session(config.get("pool_size", 32))
+
+    listings = list_spaces(spaces, base_url, output_dir)
+    results = [run_space(space, base_url, output_dir, listings) for space in spaces]
+    results += [run_root(root, base_url, output_dir) for root in roots]
+
+    close_cache()
+    print_summary(results)
+    with open(os.path.join(output_dir, "batch_report.json"), "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    report(args, exporter="batch", config=os.path.basename(args.config))
+    limiter.print_summary()
+    if any(r["error"] or r.get("failed") for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
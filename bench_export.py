@@ -0,0 +1,126 @@
+"""Сквозной офлайн-замер выгрузки на локальной заглушке Confluence.
+
+Поднимает mock_confluence с пространством заданного размера, по очереди
+запускает new_way_saver_5.py и wiki_saver.py во временных каталогах и
+печатает страниц/с, МБ/с, пиковый RSS и время по фазам. Фазы считаются
+по запросам, пришедшим на заглушку: от первого до последнего запроса
+каждого вида (листинг, страницы, дети, списки вложений, скачивания).
+
+запуск: python bench_export.py --pages 500 --latency-ms 20 [--saver-args "--workers 8"] [--json bench.json]
+"""
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_confluence
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# new_way_saver_5.py берёт адрес из константы BASE_URL — подменяем её перед main()
+SAVER_RUNNER = ("import sys; sys.path.insert(0, {repo!r}); import new_way_saver_5 as m; "
+                "m.BASE_URL = {base_url!r}; sys.argv = ['new_way_saver_5.py'] + {args!r}; m.main()")
+
+
+def exporter_commands(base_url, root_page_id, workdir, args):
+    return {
+        "new_way_saver_5": [sys.executable, "-c", SAVER_RUNNER.format(
+            repo=REPO_DIR, base_url=base_url, args=shlex.split(args.saver_args))],
+        "wiki_saver": [sys.executable, os.path.join(REPO_DIR, "wiki_saver.py"), base_url, root_page_id,
+                       os.path.join(workdir, "export")] + shlex.split(args.wiki_saver_args),
+    }
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def run_exporter(name, command, workdir, stats, pages):
+    """Запускает выгрузку в workdir и собирает замеры; RSS берётся из os.wait4 дочернего процесса."""
+    env = dict(os.environ, UNAME="bench", PASSWD="bench", CERT_PATH=os.devnull)
+    log_path = os.path.join(workdir, "output.log")
+    stats.reset()
+    started = time.monotonic()
+    with open(log_path, "w", encoding="utf-8") as log:
+        proc = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.monotonic() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    served = sum(kind["bytes"] for kind in stats.kinds.values())
+    return {
+        "exporter": name,
+        "exit_code": proc.returncode,
+        "seconds": elapsed,
+        "pages_per_s": pages / elapsed,
+        "mb_per_s": served / elapsed / 2 ** 20,
+        "served_mb": served / 2 ** 20,
+        "export_mb": dir_size(os.path.join(workdir, "export")) / 2 ** 20,
+        "peak_rss_mb": rusage.ru_maxrss / 1024,  # в Linux ru_maxrss — в КБ
+        "throttled": stats.throttled,
+        "phases": {kind: dict(entry, seconds=entry["last"] - entry["first"])
+                   for kind, entry in sorted(stats.kinds.items(), key=lambda kv: kv[1]["first"])},
+        "log": log_path,
+    }
+
+
+def print_result(result):
+    status = "ok" if result["exit_code"] == 0 else f"код выхода {result['exit_code']}, см. {result['log']}"
+    print(f"\n== {result['exporter']} ({status})")
+    print(f"  время {result['seconds']:.1f} с, {result['pages_per_s']:.1f} стр/с, "
+          f"{result['mb_per_s']:.2f} МБ/с (принято {result['served_mb']:.1f} МБ, на диске {result['export_mb']:.1f} МБ), "
+          f"пиковый RSS {result['peak_rss_mb']:.0f} МБ, ответов 429: {result['throttled']}")
+    print(f"  {'фаза':<12} {'запросов':>9} {'МБ':>8} {'начало, с':>10} {'длит., с':>9}")
+    for kind, phase in result["phases"].items():
+        print(f"  {kind:<12} {phase['count']:>9} {phase['bytes'] / 2 ** 20:>8.1f} "
+              f"{phase['first']:>10.1f} {phase['seconds']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-замер выгрузки на заглушке Confluence")
+    mock_confluence.add_space_args(parser)
+    parser.add_argument("--exporters", nargs="+", default=["new_way_saver_5", "wiki_saver"],
+                        choices=["new_way_saver_5", "wiki_saver"])
+    parser.add_argument("--saver-args", default="", help="Доп. аргументы new_way_saver_5.py, например \"--workers 8\"")
+    parser.add_argument("--wiki-saver-args", default="", help="Доп. аргументы wiki_saver.py")
+    parser.add_argument("--json", help="Куда записать результаты в JSON")
+    parser.add_argument("--keep", action="store_true", help="Не удалять каталоги с выгрузкой")
+    args = parser.parse_args()
+
+    space = mock_confluence.space_from_args(args)
+    stats = mock_confluence.RequestStats()
+    server = mock_confluence.serve(space, stats=stats, **mock_confluence.server_options(args))
+    base_url = "http://%s:%d/wiki" % server.server_address
+    print(f"Заглушка: {base_url}, страниц {len(space.pages)}, глубина {args.depth}, "
+          f"тело {args.body_kb} КБ, вложений {args.attachments} x {args.attachment_kb} КБ, "
+          f"задержка {args.latency_ms} мс, 429: {args.rate_429:.0%}")
+
+    results = []
+    try:
+        for name in args.exporters:
+            workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+            command = exporter_commands(base_url, space.pages[0]["id"], workdir, args)[name]
+            result = run_exporter(name, command, workdir, stats, len(space.pages))
+            print_result(result)
+            results.append(result)
+            if not args.keep and result["exit_code"] == 0:
+                shutil.rmtree(workdir)
+    finally:
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
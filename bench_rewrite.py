@@ -0,0 +1,81 @@
+"""Микро-бенчмарк переписывания ссылок: время на одну страницу для больших страниц.
+
+запуск: python bench_rewrite.py [--rows 2000 5000] [--attachments 200] [--repeat 3]
+"""
+import argparse
+import os
+import re
+import time
+
+from bs4 import BeautifulSoup
+
+import new_way_saver_5 as saver
+
+
+def make_page(rows, attachments):
+    """Страница в духе body.view: большая таблица со ссылками на страницы и картинками-вложениями."""
+    cells = []
+    for i in range(rows):
+        att = i % attachments
+        cells.append(
+            f"<tr><td>{i}</td>"
+            f"<td><a href=\"/wiki/pages/viewpage.action?pageId={1000 + i % 500}\">страница {i}</a></td>"
+            f"<td><a href=\"/wiki/display/ISE/Page+{i % 500}\">display</a></td>"
+            f"<td><img src=\"/wiki/download/attachments/1/file{att}.png?version=1&amp;api=v2\"></td>"
+            f"<td><a href=\"https://example.org/{i}\">внешняя</a> текст ячейки {i}</td></tr>"
+        )
+    html = "<h1>Большая страница</h1><table>" + "".join(cells) + "</table>"
+    attachments_map = {f"/download/attachments/1/file{j}.png?version=1&api=v2": f"attachments/file{j}.png"
+                       for j in range(attachments)}
+    pageid_to_path = {str(1000 + j): f"export/space/page{j}.html" for j in range(500)}
+    title_to_id = {("ISE", f"Page {j}"): str(1000 + j) for j in range(500)}
+    return html, attachments_map, pageid_to_path, title_to_id
+
+
+def rewrite_links_legacy(html, pageid_to_path, attachments_map, current_path):
+    """Прежняя реализация: дерево BeautifulSoup, два обхода и перебор всех вложений для каждого атрибута."""
+    soup = BeautifulSoup(html, "html.parser")
+    for a in soup.find_all("a", href=True):
+        m = re.search(r"pageId=(\d+)", a["href"])
+        if m and m.group(1) in pageid_to_path:
+            a["href"] = os.path.relpath(pageid_to_path[m.group(1)], os.path.dirname(current_path))
+    for tag in soup.find_all(["img", "a"]):
+        for attr in ["src", "href"]:
+            if tag.has_attr(attr):
+                val = tag[attr]
+                for orig, new in attachments_map.items():
+                    if val.endswith(orig):
+                        tag[attr] = new
+    return str(soup)
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[500, 2000, 5000])
+    parser.add_argument("--attachments", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    current = "export/space/current.html"
+    print(f"{'строк':>6} {'КБ':>7} {'bs4, мс':>10} {'потоковый, мс':>14} {'с текстом, мс':>14}")
+    for rows in args.rows:
+        html, attachments_map, pageid_to_path, title_to_id = make_page(rows, args.attachments)
+        legacy = timed(lambda: rewrite_links_legacy(html, pageid_to_path, attachments_map, current), args.repeat)
+        stream = timed(lambda: "".join(saver.rewrite_links(html, pageid_to_path, attachments_map, current,
+                                                           title_to_id=title_to_id)), args.repeat)
+        with_text = timed(lambda: "".join(saver.rewrite_links(html, pageid_to_path, attachments_map, current,
+                                                              title_to_id=title_to_id, text=[])), args.repeat)
+        print(f"{rows:>6} {len(html) // 1024:>7} {legacy * 1000:>10.1f} {stream * 1000:>14.1f} {with_text * 1000:>14.1f}")
+
+if __name__ == "__main__":
+    main()
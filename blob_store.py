@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+class BlobStore:
+    """Хранилище вложений по содержимому: <root>/<sha256>.
+
+    index.json связывает "id вложения:версия" с sha256, поэтому вложение той
+    же версии больше не скачивается. Одинаковые файлы с разных страниц лежат
+    на диске один раз, а в attachments/ страницы кладётся жёсткая ссылка на
+    blob (или копия, если файловая система не умеет hardlink) — ссылки в HTML
+    переписывать не нужно.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, "index.json")
+        os.makedirs(root, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                self.index = json.load(f)
+        self.lock = threading.Lock()
+        self.skipped_bytes = 0  # не скачано: blob этой версии уже был
+        self.deduped_bytes = 0  # скачано, но на диске не продублировано
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def fetch(self, key, download, dest):
+        """Кладёт в dest вложение с ключом key ("id:версия" или None, если версия неизвестна).
+
+        download(path) скачивает вложение в path и возвращает True при успехе;
+        вызывается, только если blob для key ещё не известен. Возвращает True,
+        если пришлось качать.
+        """
+        with self.lock:
+            digest = self.index.get(key) if key else None
+        if digest and os.path.exists(self.blob_path(digest)):
+            with self.lock:
+                self.skipped_bytes += os.path.getsize(self.blob_path(digest))
+            self.link(self.blob_path(digest), dest)
+            return False
+
+        if key:
+            # постоянное имя, чтобы недокачанный tmp.part продолжился в следующем запуске
+            tmp = os.path.join(self.root, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".download")
+        else:
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".download")
+            os.close(fd)
+        try:
+            if not download(tmp):
+                return True  # например, 404 — ссылку не создаём
+            digest = file_sha256(tmp)
+            blob = self.blob_path(digest)
+            with self.lock:
+                if os.path.exists(blob):
+                    self.deduped_bytes += os.path.getsize(blob)
+                else:
+                    os.replace(tmp, blob)
+                if key:
+                    self.index[key] = digest
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.link(blob, dest)
+        return True
+
+    def link(self, blob, dest):
+        if os.path.exists(dest) and os.path.samefile(blob, dest):
+            return
+        tmp = dest + ".link"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            shutil.copyfile(blob, tmp)
+        os.replace(tmp, dest)
+
+    def save(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+    def report(self):
+        mb = 1024 * 1024
+        print(f"Хранилище вложений: не скачано повторно {self.skipped_bytes / mb:.1f} МБ, "
+              f"не продублировано на диске {(self.skipped_bytes + self.deduped_bytes) / mb:.1f} МБ")
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,206 @@
+import threading
+import time
+
+import requests
+
+from export_metrics import METRICS, endpoint_kind
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_TIMEOUT = 60  # сек; без таймаута зависшее соединение блокирует выгрузку навсегда
+BACKOFF_STATUSES = (429, 503)  # сервер прямо просит сбавить темп
+LATENCY_FACTOR = 2.0  # задержка выше базовой во столько раз считается перегрузкой
+OFFLINE = False  # --offline: сеть выключена, ответы только из HTTP-кэша (response_cache)
+
+
+class RateLimiter:
+    """Общий для всех потоков ограничитель запросов к Confluence.
+
+    Темп задаёт ведро токенов (rate запросов в секунду, запас burst), а
+    число одновременных запросов — окно limit. Оба подстраиваются по AIMD:
+    каждый успешный ответ понемногу поднимает их к максимуму, а 429/503 или
+    выросшая задержка режут вдвое (не чаще раза в cooldown секунд, чтобы одна
+    волна отказов не обнулила темп). Задержка сравнивается с базовой своего
+    вида запроса (export_metrics.endpoint_kind): окно листинга с телами
+    всегда дольше списка вложений, и это не перегрузка. Retry-After останавливает все потоки,
+    а не только получивший его.
+    """
+
+    def __init__(self, max_rps=50.0, max_concurrency=16, min_rps=0.5, cooldown=2.0):
+        self.cond = threading.Condition()
+        self.max_rps = max_rps
+        self.min_rps = min_rps
+        self.max_concurrency = max_concurrency
+        self.cooldown = cooldown
+        # стартуем с половины и разгоняемся, пока сервер отвечает быстро
+        self.rate = max(min_rps, max_rps / 2)
+        self.limit = max(1.0, max_concurrency / 2)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_backoff = 0.0
+        self.backoffs = 0
+        self.latency = {}  # {вид запроса: скользящее среднее задержки}
+        self.base_latency = {}  # {вид запроса: наименьшее скользящее среднее — задержка здорового сервера}
+
+    def acquire(self):
+        """Ждёт свободного места в окне и токена; возвращает момент начала запроса."""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= int(self.limit):
+                    wait = None  # ждём release()
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return now
+                self.cond.wait(wait)
+
+    def release(self, status, seconds, retry_after=None, keep_slot=False, kind="other"):
+        """Возвращает место в окне и подстраивает темп по ответу (status=None — обрыв связи).
+
+        kind — вид запроса (endpoint_kind): задержка сравнивается с базовой для него.
+
+        keep_slot=True — только подстройка темпа: тело потокового ответа ещё
+        читается, место освободит free().
+        """
+        with self.cond:
+            if not keep_slot:
+                self.in_flight -= 1
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if status in BACKOFF_STATUSES or status is None:
+                self._backoff(now)
+            elif status < 500:
+                latency = self.latency.get(kind)
+                latency = seconds if latency is None else 0.8 * latency + 0.2 * seconds
+                self.latency[kind] = latency
+                self.base_latency[kind] = min(self.base_latency.get(kind, latency), latency)
+                if latency > LATENCY_FACTOR * self.base_latency[kind] and latency > 0.05:
+                    self._backoff(now)
+                else:
+                    # аддитивный рост: окно +1 примерно за каждый полный «круг» запросов
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                    self.rate = min(self.max_rps, self.rate + self.max_rps / 100)
+            self.cond.notify_all()
+
+    def free(self):
+        """Освобождает место, оставленное release(keep_slot=True)."""
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def _backoff(self, now):
+        if now - self.last_backoff < self.cooldown:
+            return
+        self.last_backoff = now
+        self.backoffs += 1
+        self.limit = max(1.0, self.limit / 2)
+        self.rate = max(self.min_rps, self.rate / 2)
+        # после сброса темпа задержка должна упасть; иначе новую базу берём с текущего уровня
+        for kind, latency in self.latency.items():
+            self.base_latency[kind] = max(self.base_latency[kind], latency / LATENCY_FACTOR)
+
+    def print_summary(self):
+        print(f"Темп запросов в конце: {self.rate:.1f} в с, одновременно до {int(self.limit)}; "
+              f"снижений темпа: {self.backoffs}")
+
+
+LIMITER = RateLimiter()
+
+
+def add_limiter_args(parser):
+    parser.add_argument("--max-rps", type=float, default=LIMITER.max_rps,
+                        help="Потолок запросов в секунду к Confluence (темп подстраивается по 429/503 и задержке)")
+    parser.add_argument("--max-concurrency", type=int, default=LIMITER.max_concurrency,
+                        help="Потолок одновременных запросов к Confluence "
+                             "(скачивание вложения занимает место, пока не дочитано)")
+
+
+def configure_limiter(args):
+    """Пересоздаёт общий LIMITER по аргументам командной строки (до первого запроса)."""
+    global LIMITER
+    LIMITER = RateLimiter(max_rps=args.max_rps, max_concurrency=args.max_concurrency)
+    return LIMITER
+
+
+def hold_slot(r, limiter):
+    """Место в окне limiter держится, пока потоковый ответ r не закроют (r.close() или with r)."""
+    close = r.close
+    lock = threading.Lock()
+    held = [True]
+
+    def close_and_free():
+        try:
+            close()
+        finally:
+            with lock:
+                if held[0]:
+                    held[0] = False
+                    limiter.free()
+
+    r.close = close_and_free
+    return r
+
+
+def retry_get(session, url, max_retries=5, delay=1, max_delay=60, **kwargs):
+    """GET с повторами.
+
+    429, 5xx, обрывы соединения и таймауты повторяются с экспоненциальной
+    паузой (delay, 2*delay, 4*delay, ... но не больше max_delay); Retry-After
+    от сервера имеет приоритет. 404 → None, прочие ошибки — raise_for_status.
+    Если повторы исчерпаны, пробрасывается последняя ошибка. Каждая попытка
+    проходит через общий LIMITER и учитывается в export_metrics.METRICS.
+    Успешный ответ с stream=True держит место в окне LIMITER, пока его не
+    закроют: вызывающий обязан закрыть его (r.close() или with r).
+    """
+    if OFFLINE:
+        raise requests.ConnectionError(f"--offline: ответа нет в HTTP-кэше: {url}")
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    kind = endpoint_kind(url)
+    for attempt in range(max_retries):
+        pause = min(delay * 2 ** attempt, max_delay)
+        last = attempt == max_retries - 1
+        LIMITER.acquire()
+        started = time.perf_counter()
+        try:
+            r = session.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            LIMITER.release(None, time.perf_counter() - started, kind=kind)
+            METRICS.request(url, "error", time.perf_counter() - started)
+            if last:
+                raise
+            METRICS.retry(url, e.__class__.__name__)
+            print(f"⚠️ {e.__class__.__name__} for {url}. Waiting {pause} seconds...")
+            time.sleep(pause)
+            continue
+        # для потоковых ответов тело ещё не прочитано — берём размер из заголовка
+        nbytes = int(r.headers.get("Content-Length", 0)) if kwargs.get("stream") else len(r.content)
+        seconds = time.perf_counter() - started
+        retry_after = r.headers.get("Retry-After", "")
+        retry_after = int(retry_after) if retry_after.isdigit() else None
+        # темп подстраивается по времени до заголовков, а место потокового ответа
+        # занято, пока тело не дочитают — крупные вложения и есть самая долгая нагрузка
+        stream = bool(kwargs.get("stream")) and r.status_code < 400
+        limiter = LIMITER
+        limiter.release(r.status_code, seconds, retry_after, keep_slot=stream, kind=kind)
+        METRICS.request(url, r.status_code, seconds, nbytes)
+        if r.status_code in RETRY_STATUSES and not last:
+            METRICS.retry(url, r.status_code)
+            if retry_after is not None:
+                pause = retry_after
+            print(f"⚠️ {r.status_code} for {url}. Waiting {pause} seconds...")
+            r.close()
+            time.sleep(pause)
+            continue
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        return hold_slot(r, limiter) if stream else r
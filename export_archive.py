@@ -0,0 +1,382 @@
+"""Выгрузка в один архив вместо тысяч файлов: ZIP, tar или SQLite.
+
+Писатель (open_archive) принимает файлы по именам относительно корня
+выгрузки: каждый файл сначала пишется во временный буфер (до SPOOL_BYTES —
+в памяти, больше — во временный файл) и переливается в архив потоком,
+когда его запись закончилась без ошибок, — выгрузка не раскладывается по
+диску, вложение в сотни мегабайт не держится в памяти целиком, а
+недокачанное вложение не оставляет в архиве обрывок. Запись в сам архив
+идёт под блокировкой, так что писать можно из пула потоков.
+
+Произвольный доступ: у ZIP это центральный каталог, у SQLite — первичный
+ключ таблицы files, для tar рядом пишется <архив>.index.json со смещениями.
+Дерево страниц лежит в _tree.json (ZIP/tar) или в таблице pages (SQLite).
+
+запуск: python export_archive.py serve export.zip [--port 8000]
+        python export_archive.py extract export.zip каталог
+"""
+import argparse
+import io
+import json
+import mimetypes
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+TREE_NAME = "_tree.json"
+SPOOL_BYTES = 8 * 1024 * 1024  # файл больше этого буферизуется на диске, а не в памяти
+COPY_BUFFER = 1024 * 1024
+
+
+def archive_format(path):
+    """Формат по расширению: zip, tar или sqlite."""
+    lower = path.lower()
+    if lower.endswith(".zip"):
+        return "zip"
+    if lower.endswith(".tar"):
+        return "tar"
+    if lower.endswith((".sqlite", ".sqlite3", ".db")):
+        return "sqlite"
+    raise ValueError(f"Неизвестный формат архива: {path} (ожидается .zip, .tar или .sqlite)")
+
+
+def archive_path(name):
+    """Имя внутри архива: без "./" и всегда через "/"."""
+    return os.path.normpath(name).replace(os.sep, "/")
+
+
+def spool_chunks(chunks, limit=SPOOL_BYTES):
+    """Собирает куски байт: (bytes, None), если уложились в limit, иначе (None, путь временного файла).
+
+    И то и другое можно передать из процесса отрисовки; файл удаляет тот,
+    кто его запишет (ArchiveWriter.write_file).
+    """
+    parts = []
+    size = 0
+    chunks = iter(chunks)
+    for data in chunks:
+        parts.append(data)
+        size += len(data)
+        if size > limit:
+            break
+    else:
+        return b"".join(parts), None
+    fd, path = tempfile.mkstemp(suffix=".part")
+    with os.fdopen(fd, "wb") as f:
+        f.writelines(parts)
+        parts = None
+        for data in chunks:
+            f.write(data)
+    return None, path
+
+
+class ArchiveEntry:
+    """Файл в архиве: пишется как обычный, в архив уходит при выходе из with без ошибки.
+
+    До выхода из with содержимое лежит в SpooledTemporaryFile: мелкие файлы в
+    памяти, крупные — во временном файле; перемотка и усечение (докачка с
+    Range) работают как у обычного файла.
+    """
+
+    def __init__(self, writer, name):
+        self.writer = writer
+        self.name = name
+        self.file = tempfile.SpooledTemporaryFile(SPOOL_BYTES)
+        self.discarded = False
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def truncate(self, size=None):
+        return self.file.truncate(size)
+
+    def discard(self):
+        """Не класть файл в архив (например, вложение оказалось удалённым)."""
+        self.discarded = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None and not self.discarded:
+                size = self.file.seek(0, io.SEEK_END)
+                self.file.seek(0)
+                self.writer.commit(self.name, self.file, size)
+            else:
+                self.writer.release(self.name)
+        finally:
+            self.file.close()
+        return False
+
+
+class ArchiveWriter:
+    """Общая часть писателей: учёт имён, дерево страниц и блокировка."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.names = set()  # записанные и записываемые сейчас
+        self.pages = []
+        self.bytes = 0
+
+    def open(self, name):
+        """ArchiveEntry для name или None, если такой файл уже есть (первая запись побеждает)."""
+        name = archive_path(name)
+        with self.lock:
+            if name in self.names:
+                return None
+            self.names.add(name)
+        return ArchiveEntry(self, name)
+
+    def release(self, name):
+        with self.lock:
+            self.names.discard(name)
+
+    def write_text(self, name, text):
+        """Записывает (или, если имя уже занято, пропускает) текстовый файл."""
+        self.write_bytes(name, (text.encode("utf-8"),))
+
+    def write_bytes(self, name, chunks):
+        """Записывает файл из кусков байт; если имя уже занято, куски всё равно выбираются до конца."""
+        entry = self.open(name)
+        if entry is None:
+            for _ in chunks:
+                pass
+            return
+        with entry:
+            for data in chunks:
+                entry.write(data)
+
+    def write_file(self, name, path):
+        """Переливает в архив готовый файл path (например, от spool_chunks) и удаляет его."""
+        try:
+            name = archive_path(name)
+            with self.lock:
+                if name in self.names:
+                    return
+                self.names.add(name)
+            try:
+                with open(path, "rb") as f:
+                    self.commit(name, f, os.path.getsize(path))
+            except BaseException:
+                self.release(name)
+                raise
+        finally:
+            os.remove(path)
+
+    def add_page(self, page_id, title, parent_id, name):
+        with self.lock:
+            self.pages.append({"id": page_id, "title": title, "parent": parent_id, "path": archive_path(name)})
+
+    def commit(self, name, f, size):
+        """Переливает size байт из файлового объекта f в архив под именем name."""
+        with self.lock:
+            self.write_entry(name, f, size)
+            self.bytes += size
+
+    def write_tree(self):
+        data = json.dumps(self.pages, ensure_ascii=False).encode("utf-8")
+        self.write_entry(TREE_NAME, io.BytesIO(data), len(data))
+
+    def close(self):
+        with self.lock:
+            self.finish()
+        print(f"Архив {self.path}: файлов {len(self.names)}, {self.bytes / (1024 * 1024):.1f} МБ")
+
+
+class ZipWriter(ArchiveWriter):
+    def __init__(self, path):
+        super().__init__(path)
+        self.zf = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def write_entry(self, name, f, size):
+        # картинки и архивы уже сжаты — не тратим на них время
+        compress = zipfile.ZIP_DEFLATED if name.endswith((".html", ".js", ".json", ".txt", ".css")) else zipfile.ZIP_STORED
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = compress
+        info.file_size = size
+        with self.zf.open(info, "w", force_zip64=True) as out:
+            shutil.copyfileobj(f, out, COPY_BUFFER)
+
+    def finish(self):
+        self.write_tree()
+        self.zf.close()
+
+
+class TarWriter(ArchiveWriter):
+    def __init__(self, path):
+        super().__init__(path)
+        self.tf = tarfile.open(path, "w", format=tarfile.PAX_FORMAT)
+        self.index = {}  # {имя: [смещение данных, размер]}
+
+    def write_entry(self, name, f, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        self.tf.addfile(info, f)
+        # данные лежат перед текущим концом архива, выровненные на блок
+        padded = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.index[name] = [self.tf.offset - padded, size]
+
+    def finish(self):
+        self.write_tree()
+        self.tf.close()
+        with open(self.path + ".index.json", "w", encoding="utf-8") as f:
+            json.dump(self.index, f, ensure_ascii=False)
+
+
+class SqliteWriter(ArchiveWriter):
+    def __init__(self, path):
+        super().__init__(path)
+        if os.path.exists(path):
+            os.remove(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE files (name TEXT PRIMARY KEY, size INTEGER, data BLOB)")
+        self.db.execute("CREATE TABLE pages (id TEXT PRIMARY KEY, title TEXT, parent TEXT, path TEXT)")
+
+    def write_entry(self, name, f, size):
+        if not hasattr(self.db, "blobopen"):  # Python < 3.11: BLOB только целиком
+            self.db.execute("INSERT INTO files VALUES (?, ?, ?)", (name, size, f.read()))
+            return
+        cursor = self.db.execute("INSERT INTO files VALUES (?, ?, zeroblob(?))", (name, size, size))
+        with self.db.blobopen("files", "data", cursor.lastrowid) as blob:
+            shutil.copyfileobj(f, blob, COPY_BUFFER)
+
+    def finish(self):
+        self.db.executemany("INSERT OR REPLACE INTO pages VALUES (:id, :title, :parent, :path)", self.pages)
+        self.db.execute("CREATE INDEX pages_parent ON pages (parent)")
+        self.db.commit()
+        self.db.close()
+
+
+def open_archive(path):
+    return {"zip": ZipWriter, "tar": TarWriter, "sqlite": SqliteWriter}[archive_format(path)](path)
+
+
+# ---------- ЧТЕНИЕ: ЛОКАЛЬНЫЙ СЕРВЕР И РАСПАКОВКА ----------
+
+class ArchiveReader:
+    """Чтение файла архива по имени без распаковки."""
+
+    def __init__(self, path):
+        self.path = path
+        self.format = archive_format(path)
+        self.lock = threading.Lock()
+        if self.format == "zip":
+            self.zf = zipfile.ZipFile(path)
+        elif self.format == "tar":
+            index_path = path + ".index.json"
+            if os.path.exists(index_path):
+                with open(index_path, encoding="utf-8") as f:
+                    self.index = json.load(f)
+            else:
+                # индекса нет (архив переименовали?) — один раз проходим заголовки
+                with tarfile.open(path) as tf:
+                    self.index = {m.name: [m.offset_data, m.size] for m in tf if m.isfile()}
+            self.f = open(path, "rb")
+        else:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+
+    def names(self):
+        if self.format == "zip":
+            return self.zf.namelist()
+        if self.format == "tar":
+            return list(self.index)
+        return [row[0] for row in self.db.execute("SELECT name FROM files")]
+
+    def read(self, name):
+        """Содержимое файла или None, если его нет."""
+        with self.lock:
+            if self.format == "zip":
+                try:
+                    return self.zf.read(name)
+                except KeyError:
+                    return None
+            if self.format == "tar":
+                if name not in self.index:
+                    return None
+                offset, size = self.index[name]
+                self.f.seek(offset)
+                return self.f.read(size)
+            row = self.db.execute("SELECT data FROM files WHERE name = ?", (name,)).fetchone()
+            return row[0] if row else None
+
+
+def extract(reader, target):
+    for name in reader.names():
+        if ".." in name.split("/"):
+            print(f"⚠️ Пропускаю подозрительное имя: {name}")
+            continue
+        dest = os.path.join(target, *name.split("/"))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, "wb") as f:
+            f.write(reader.read(name))
+    print(f"Распаковано в {target}")
+
+
+def make_handler(reader):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            name = unquote(urlparse(self.path).path).lstrip("/")
+            if not name or name.endswith("/"):
+                name += "index.html"
+            data = reader.read(name)
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if content_type.startswith("text/") or content_type.endswith("javascript"):
+                content_type += "; charset=utf-8"
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Просмотр и распаковка выгрузки-архива")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="Раздать архив по HTTP")
+    serve.add_argument("archive")
+    serve.add_argument("--port", type=int, default=8000)
+    unpack = sub.add_parser("extract", help="Распаковать архив в каталог")
+    unpack.add_argument("archive")
+    unpack.add_argument("target")
+    args = parser.parse_args()
+
+    reader = ArchiveReader(args.archive)
+    if args.command == "extract":
+        extract(reader, args.target)
+        return
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(reader))
+    print(f"Выгрузка {args.archive}: http://127.0.0.1:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
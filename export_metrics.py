@@ -0,0 +1,190 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+ENDPOINTS = [
+    ("download", re.compile(r"/download/(attachments|thumbnails)/")),
+    ("children", re.compile(r"/rest/api/content/\d+/child/page")),
+    ("attachments", re.compile(r"/rest/api/content/\d+/child/attachment")),
+    ("page", re.compile(r"/rest/api/content/\d+")),
+    ("search", re.compile(r"/rest/api/search")),
+    ("listing", re.compile(r"/rest/api/content/?(\?|$)")),
+]
+
+
+def endpoint_kind(url):
+    """Вид запроса к Confluence по URL: listing, search, page, children, attachments, download или other."""
+    for kind, pattern in ENDPOINTS:
+        if pattern.search(url):
+            return kind
+    return "other"
+
+
+class Metrics:
+    """Счётчики выгрузки: запросы по видам, повторы и время фаз.
+
+    Запись — словарь и сложение под блокировкой, поэтому метрики можно
+    держать включёнными всегда.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}  # {вид: {"count", "seconds", "max_seconds", "bytes", "statuses": {код: n}}}
+        self.retries = {}  # {(вид, причина): n}
+        self.phases = {}  # {фаза: {"count", "seconds"}}
+
+    def request(self, url, status, seconds, nbytes=0):
+        kind = endpoint_kind(url)
+        with self.lock:
+            entry = self.requests.setdefault(
+                kind, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0, "statuses": {}})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["bytes"] += nbytes
+            entry["statuses"][str(status)] = entry["statuses"].get(str(status), 0) + 1
+
+    def retry(self, url, reason):
+        key = (endpoint_kind(url), str(reason))
+        with self.lock:
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            entry = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+
+    def merge_phases(self, phases):
+        """Добавляет время фаз, посчитанное в другом процессе ({фаза: {"count", "seconds"}})."""
+        with self.lock:
+            for name, e in phases.items():
+                entry = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+                entry["count"] += e["count"]
+                entry["seconds"] += e["seconds"]
+
+    @contextmanager
+    def phase(self, name):
+        """with METRICS.phase("rewrite_links"): ... — суммирует время и число вызовов фазы."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - started)
+
+    @contextmanager
+    def streamed_phase(self, name, producer, chunks):
+        """with METRICS.streamed_phase("write", "rewrite_links", chunks) as chunks: — для потоковой записи.
+
+        Время, за которое итератор chunks выдаёт куски, идёт в фазу producer,
+        остальное время блока (сама запись) — в фазу name.
+        """
+        produced = [0.0]
+
+        def timed():
+            it = iter(chunks)
+            while True:
+                started = time.perf_counter()
+                try:
+                    chunk = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    produced[0] += time.perf_counter() - started
+                yield chunk
+
+        started = time.perf_counter()
+        try:
+            yield timed()
+        finally:
+            total = time.perf_counter() - started
+            self.add_phase(producer, produced[0])
+            self.add_phase(name, total - produced[0])
+
+    def print_summary(self):
+        mb = 1024 * 1024
+        print(f"\n{'запросы':<12} {'кол-во':>7} {'сред., мс':>10} {'макс., мс':>10} {'МБ':>8} {'429':>5} "
+              f"{'5xx':>5} {'повторов':>9}")
+        for kind, e in sorted(self.requests.items()):
+            s5xx = sum(n for code, n in e["statuses"].items() if code.startswith("5"))
+            retries = sum(n for (k, _), n in self.retries.items() if k == kind)
+            print(f"{kind:<12} {e['count']:>7} {e['seconds'] / e['count'] * 1000:>10.1f} "
+                  f"{e['max_seconds'] * 1000:>10.1f} {e['bytes'] / mb:>8.1f} {e['statuses'].get('429', 0):>5} "
+                  f"{s5xx:>5} {retries:>9}")
+        if self.phases:
+            print(f"\n{'фаза':<16} {'вызовов':>8} {'всего, с':>9} {'сред., мс':>10}")
+            for name, e in sorted(self.phases.items(), key=lambda kv: -kv[1]["seconds"]):
+                print(f"{name:<16} {e['count']:>8} {e['seconds']:>9.2f} {e['seconds'] / e['count'] * 1000:>10.1f}")
+
+    def snapshot(self, **labels):
+        with self.lock:
+            return {
+                "started": self.started,
+                "finished": time.time(),
+                "labels": labels,
+                "requests": json.loads(json.dumps(self.requests)),
+                "retries": [{"endpoint": k, "reason": r, "count": n} for (k, r), n in self.retries.items()],
+                "phases": dict((k, dict(v)) for k, v in self.phases.items()),
+            }
+
+    def write_jsonl(self, path, **labels):
+        """Дописывает в path одну строку JSON со всеми метриками прогона."""
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.snapshot(**labels), ensure_ascii=False) + "\n")
+
+    def write_prometheus(self, path, **labels):
+        """Пишет метрики в формате textfile-коллектора node_exporter (атомарно, через переименование)."""
+        base = "".join(f',{k}="{v}"' for k, v in sorted(labels.items()))
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP confluence_export_{name} {help_text}")
+            lines.append(f"# TYPE confluence_export_{name} {kind}")
+            for sample_labels, value in samples:
+                text = (",".join(f'{k}="{v}"' for k, v in sample_labels) + base).lstrip(",")
+                lines.append(f"confluence_export_{name}{{{text}}} {value}" if text else f"confluence_export_{name} {value}")
+
+        snap = self.snapshot()
+        reqs = snap["requests"]
+        metric("requests_total", "counter", "HTTP-запросы к Confluence",
+               [((("endpoint", k), ("status", code)), n) for k, e in reqs.items() for code, n in e["statuses"].items()])
+        metric("request_seconds_sum", "counter", "Суммарное время запросов",
+               [((("endpoint", k),), e["seconds"]) for k, e in reqs.items()])
+        metric("request_seconds_max", "gauge", "Самый долгий запрос",
+               [((("endpoint", k),), e["max_seconds"]) for k, e in reqs.items()])
+        metric("response_bytes_total", "counter", "Получено байт",
+               [((("endpoint", k),), e["bytes"]) for k, e in reqs.items()])
+        metric("retries_total", "counter", "Повторы запросов",
+               [((("endpoint", r["endpoint"]), ("reason", r["reason"])), r["count"]) for r in snap["retries"]])
+        metric("phase_seconds_sum", "counter", "Время по фазам выгрузки",
+               [((("phase", k),), e["seconds"]) for k, e in snap["phases"].items()])
+        metric("phase_calls_total", "counter", "Вызовы фаз выгрузки",
+               [((("phase", k),), e["count"]) for k, e in snap["phases"].items()])
+        metric("last_run_seconds", "gauge", "Длительность прогона",
+               [((), snap["finished"] - snap["started"])])
+
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+METRICS = Metrics()
+
+
+def add_metrics_args(parser):
+    parser.add_argument("--metrics-jsonl", help="Дописать метрики прогона строкой JSON в этот файл")
+    parser.add_argument("--metrics-prom", help="Записать метрики в textfile для Prometheus node_exporter")
+
+
+def report(args, **labels):
+    """Печатает сводку и, если заданы, пишет метрики в файлы из аргументов командной строки."""
+    METRICS.print_summary()
+    if args.metrics_jsonl:
+        METRICS.write_jsonl(args.metrics_jsonl, **labels)
+    if args.metrics_prom:
+        METRICS.write_prometheus(args.metrics_prom, **labels)
@@ -0,0 +1,82 @@
+"""Потоковое переписывание ссылок в HTML без построения дерева.
+
+Страница просматривается одним регулярным выражением: меняются только
+значения href/src в тегах <a> и <img>, всё остальное уходит в вывод
+срезами исходной строки, байт в байт. Комментарии, <script>, <style> и
+CDATA пропускаются целиком — ссылки внутри них не трогаются. Памяти
+нужно на размер страницы плюс куски вывода, а не на дерево из объектов
+Python в несколько раз больше страницы.
+"""
+import re
+from html import escape, unescape
+
+SKIP = r"<!--.*?(?:-->|\Z)|<!\[CDATA\[.*?(?:\]\]>|\Z)|<(?P<raw>script|style)\b.*?(?:</(?P=raw)\s*>|\Z)"
+LINK_TAG = r"<(?P<tag>a|img)(?=[\s/>])(?P<attrs>(?:[^>\"']|\"[^\"]*\"|'[^']*')*)>|(?P<close></a\s*>)"
+# без текста достаточно искать только <a>/<img>; для текста нужны границы всех тегов
+LINK_RE = re.compile(f"{SKIP}|{LINK_TAG}", re.S | re.I)
+TOKEN_RE = re.compile(f"{SKIP}|{LINK_TAG}|</?[A-Za-z](?:[^>\"']|\"[^\"]*\"|'[^']*')*>|<![^>]*>|<\\?[^>]*>",
+                      re.S | re.I)
+ATTR_RE = re.compile(r"([^\s=/>\"']+)(?:\s*=\s*(\"[^\"]*\"|'[^']*'|[^\s>]*))?")
+
+
+def iter_rewrite(html, rewrite, text=None):
+    """Отдаёт html кусками, заменив значения href/src у <a> и <img>.
+
+    rewrite(тег, атрибут, значение) возвращает новое значение или None,
+    если атрибут остаётся как есть; значения приходят уже без &amp;-экранирования.
+    Пара (значение, ссылка) вдобавок оборачивает тег в <a href=ссылка> — если
+    он и так не внутри <a> (так превью картинки ведёт на оригинал).
+    text — если передан список, после прохода в него добавляется текст
+    страницы без тегов (для поискового индекса).
+    """
+    pos = 0  # до этого места html уже отдан
+    last = 0  # конец предыдущего тега — между тегами лежит текст
+    parts = []
+    in_link = False
+    for m in (TOKEN_RE if text is not None else LINK_RE).finditer(html):
+        if text is not None:
+            if m.start() > last:
+                parts.append(html[last:m.start()])
+            last = m.end()
+        if m.group("close"):
+            in_link = False
+            continue
+        tag = m.group("tag")
+        if tag is None:
+            continue
+        tag = tag.lower()
+        attrs_start = m.start("attrs")
+        changes = []
+        wrap = None
+        for a in ATTR_RE.finditer(m.group("attrs")):
+            name = a.group(1).lower()
+            if name not in ("href", "src") or a.group(2) is None:
+                continue
+            raw = a.group(2)
+            value = unescape(raw[1:-1] if raw[:1] in "\"'" else raw)
+            new = rewrite(tag, name, value)
+            if new is None:
+                continue
+            if isinstance(new, tuple):
+                new, link = new
+                if not in_link:
+                    wrap = link
+            changes.append((attrs_start + a.start(2), attrs_start + a.end(2), new))
+        if tag == "a":
+            in_link = True
+        if wrap is not None:
+            yield html[pos:m.start()]
+            yield '<a href="' + escape(wrap) + '">'
+            pos = m.start()
+        for start, end, new in changes:
+            yield html[pos:start]
+            yield '"' + escape(new) + '"'
+            pos = end
+        if wrap is not None:
+            yield html[pos:m.end()]
+            yield "</a>"
+            pos = m.end()
+    yield html[pos:]
+    if text is not None:
+        parts.append(html[last:])
+        text.append(unescape(" ".join(parts)))
@@ -0,0 +1,340 @@
+"""Локальная заглушка REST API Confluence для офлайн-замеров выгрузки.
+
+Отдаёт /rest/api/content (листинг пространства и страница по id),
+/child/page, /child/attachment, скачивание вложений (с Range) и, по желанию,
+число страниц через CQL-поиск /rest/api/search на
+сгенерированном пространстве заданного размера. Умеет задержку ответа и
+случайные 429.
+
+запуск: python mock_confluence.py --port 8090 --pages 500 --depth 4 --latency-ms 20
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+SPACE_KEY = "ISE"
+
+
+class MockSpace:
+    """Детерминированно сгенерированное пространство: дерево страниц, тела и вложения."""
+
+    def __init__(self, pages=200, depth=4, body_kb=8, attachments=2, attachment_kb=64, shared_attachment=True,
+                 seed=1, key=SPACE_KEY, first_id=100000, title_words=0):
+        rnd = random.Random(seed)
+        self.key = key
+        # наименьшее ветвление, при котором pages страниц помещаются в depth уровней
+        fanout = 1
+        while sum(fanout ** k for k in range(depth)) < pages:
+            fanout += 1
+
+        self.pages = []
+        self.by_id = {}
+        for i in range(pages):
+            parent = self.pages[(i - 1) // fanout] if i else None
+            page = {
+                "id": str(first_id + i),
+                "title": self._title(i, title_words),
+                "parent": parent["id"] if parent else None,
+                "ancestors": (parent["ancestors"] + [{"id": parent["id"], "title": parent["title"]}]) if parent else [],
+                "version": 1,
+                "attachments": [],
+            }
+            self.pages.append(page)
+            self.by_id[page["id"]] = page
+
+        shared = bytes(rnd.getrandbits(8) for _ in range(attachment_kb * 1024)) if shared_attachment else None
+        for page in self.pages:
+            for j in range(attachments):
+                if j == 0 and shared is not None:
+                    name, data = "logo.png", shared  # одно и то же вложение на каждой странице
+                else:
+                    name = f"file{j}.png"
+                    data = (page["id"].encode() + bytes([j])) * (attachment_kb * 1024 // 7 + 1)
+                    data = data[:attachment_kb * 1024]
+                page["attachments"].append({"id": f"att{page['id']}{j}", "title": name, "data": data, "version": 1})
+            page["body"], page["storage"] = self._body(page, rnd, body_kb)
+        self.children = {}
+        for page in self.pages:
+            self.children.setdefault(page["parent"], []).append(page)
+
+    @staticmethod
+    def _title(i, title_words):
+        """Заголовок страницы i; title_words > 0 — длинные заголовки, и у каждой 7-й страницы он как у предыдущей."""
+        if not title_words:
+            return f"Страница {i}" if i % 10 else f"Раздел {i}/обзор"
+        n = i - 1 if i % 7 == 0 else i
+        return " ".join(["Очень длинный заголовок страницы"] * title_words) + f" {n}"
+
+    def _body(self, page, rnd, body_kb):
+        """Тело страницы в двух видах: body.view (HTML) и body.storage (тот же текст в хранимом формате)."""
+        view = [f"<h1>{page['title']}</h1>"]
+        storage = [f"<h1>{escape(page['title'])}</h1>"]
+        for _ in range(3):
+            target = rnd.choice(self.pages)
+            view.append(f'<p><a href="/wiki/pages/viewpage.action?pageId={target["id"]}">{target["title"]}</a></p>')
+            storage.append(f'<p><ac:link><ri:page ri:content-title="{escape(target["title"])}" />'
+                           f'<ac:plain-text-link-body><![CDATA[{target["title"]}]]></ac:plain-text-link-body>'
+                           f'</ac:link></p>')
+        target = rnd.choice(self.pages)
+        title = quote(target["title"], safe="").replace("%20", "+")
+        view.append(f'<p><a href="/wiki/display/{self.key}/{title}">{target["title"]}</a></p>')
+        storage.append(f'<p><ac:link><ri:page ri:space-key="{self.key}" ri:content-title="{escape(target["title"])}" />'
+                       f'</ac:link></p>')
+        for att in page["attachments"]:
+            view.append(f'<img src="/wiki/download/attachments/{page["id"]}/{quote(att["title"])}'
+                        f'?version=1&amp;modificationDate=1&amp;api=v2">')
+            storage.append(f'<ac:image><ri:attachment ri:filename="{escape(att["title"])}" /></ac:image>')
+        view.append("<div class='code panel'><pre><code class='python'>print(1 &lt; 2)</code></pre></div>")
+        storage.append('<ac:structured-macro ac:name="code"><ac:parameter ac:name="language">python</ac:parameter>'
+                       '<ac:plain-text-body><![CDATA[print(1 < 2)]]></ac:plain-text-body></ac:structured-macro>')
+        if int(page["id"]) % 10 == 5:
+            # макрос, которого нет в локальной отрисовке: такие страницы берутся в body.view
+            view.append("<span class='jira-issue'>ISE-1</span>")
+            storage.append('<ac:structured-macro ac:name="jira"><ac:parameter ac:name="key">ISE-1</ac:parameter>'
+                           '</ac:structured-macro>')
+        row = "<tr><td>ячейка</td><td>" + "текст " * 10 + "</td></tr>"
+        table = "<table>" + row * max(1, body_kb * 1024 // len(row.encode())) + "</table>"
+        view.append(table)
+        storage.append(table)
+        return "".join(view), "".join(storage)
+
+    def page_json(self, page, expand):
+        data = {"id": page["id"], "type": "page", "status": "current", "title": page["title"],
+                "_links": {"webui": f"/pages/viewpage.action?pageId={page['id']}"},
+                "_expandable": {"children": "", "space": ""}}
+        if "ancestors" in expand:
+            data["ancestors"] = [dict(a, type="page") for a in page["ancestors"]]
+        if "space" in expand:
+            data["space"] = {"key": self.key}
+        if "version" in expand:
+            data["version"] = {"number": page["version"]}
+        if "body.view" in expand:
+            data.setdefault("body", {})["view"] = {"value": page["body"], "representation": "view"}
+        if "body.storage" in expand:
+            data.setdefault("body", {})["storage"] = {"value": page["storage"], "representation": "storage"}
+        return data
+
+    def attachment_json(self, page, att):
+        return {"id": att["id"], "type": "attachment", "title": att["title"],
+                "version": {"number": att["version"]},
+                "extensions": {"mediaType": "image/png", "fileSize": len(att["data"])},
+                "_links": {"download": f"/download/attachments/{page['id']}/{quote(att['title'])}"
+                                       f"?version={att['version']}&modificationDate=1&api=v2"}}
+
+
+class RequestStats:
+    """Счётчики заглушки по видам запросов: сколько, сколько байт, первый и последний момент."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.kinds = {}
+            self.throttled = 0
+
+    def add(self, kind, size):
+        now = time.monotonic() - self.started
+        with self.lock:
+            entry = self.kinds.setdefault(kind, {"count": 0, "bytes": 0, "first": now, "last": now})
+            entry["count"] += 1
+            entry["bytes"] += size
+            entry["last"] = now
+
+
+def make_handler(space, latency=0.0, rate_429=0.0, total_size=False, search=False, etag=False, stats=None,
+                 base_path="/wiki"):
+    """Класс обработчика, замкнутый на пространство (или список пространств) и настройки."""
+    stats = stats or RequestStats()
+    spaces = space if isinstance(space, list) else [space]
+    space = spaces[0]
+    by_key = {sp.key: sp for sp in spaces}
+    owner = {pid: sp for sp in spaces for pid in sp.by_id}
+    rnd = random.Random(2)
+    routes = [
+        ("listing", re.compile(rf"^{base_path}/rest/api/content/?$")),
+        ("children", re.compile(rf"^{base_path}/rest/api/content/(\d+)/child/page/?$")),
+        ("attachments", re.compile(rf"^{base_path}/rest/api/content/(\d+)/child/attachment/?$")),
+        ("page", re.compile(rf"^{base_path}/rest/api/content/(\d+)/?$")),
+        ("download", re.compile(rf"^{base_path}/download/attachments/(\d+)/([^/]+)$")),
+        ("search", re.compile(rf"^{base_path}/rest/api/search/?$")),
+    ]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, code, body, content_type="application/json", headers=None):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, kind, data, code=200):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            if etag and code == 200:
+                tag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if self.headers.get("If-None-Match") == tag:
+                    stats.add("not_modified", 0)
+                    return self.send_body(304, b"", headers={"ETag": tag})
+                stats.add(kind, len(body))
+                return self.send_body(code, body, headers={"ETag": tag})
+            stats.add(kind, len(body))
+            self.send_body(code, body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if latency:
+                time.sleep(latency)
+            if rate_429 and rnd.random() < rate_429:
+                with stats.lock:
+                    stats.throttled += 1
+                return self.send_body(429, b"{}", headers={"Retry-After": "1"})
+
+            for kind, pattern in routes:
+                m = pattern.match(url.path)
+                if m:
+                    return getattr(self, "get_" + kind)(m, query)
+            self.send_json("other", {"message": "not found"}, 404)
+
+        def window(self, items, query, expand, kind):
+            start = int(query.get("start", 0))
+            limit = int(query.get("limit", 25))
+            chunk = items[start:start + limit]
+            data = {"results": [space.page_json(p, expand) for p in chunk],
+                    "start": start, "limit": limit, "size": len(chunk), "_links": {}}
+            if total_size:
+                data["totalSize"] = len(items)
+            if start + limit < len(items):
+                data["_links"]["next"] = f"{url_without_start(self.path)}&start={start + limit}"
+            self.send_json(kind, data)
+
+        def get_listing(self, m, query):
+            sp = by_key.get(query.get("spaceKey"))
+            self.window(sp.pages if sp else [], query, query.get("expand", ""), "listing")
+
+        def get_children(self, m, query):
+            sp = owner.get(m.group(1), space)
+            self.window(sp.children.get(m.group(1), []), query, query.get("expand", ""), "children")
+
+        def get_search(self, m, query):
+            # понимаем только запрос числа страниц пространства
+            if not search:
+                return self.send_json("search", {"message": "not found"}, 404)
+            sp = by_key.get(re.search(r'space="?(\w+)', query.get("cql", "")).group(1), space)
+            self.send_json("search", {"results": [], "start": 0, "limit": 0, "size": 0, "totalSize": len(sp.pages)})
+
+        def get_attachments(self, m, query):
+            page = owner[m.group(1)].by_id[m.group(1)] if m.group(1) in owner else None
+            if page is None:
+                return self.send_json("attachments", {}, 404)
+            results = [space.attachment_json(page, att) for att in page["attachments"]]
+            self.send_json("attachments", {"results": results, "start": 0, "limit": 1000, "size": len(results)})
+
+        def get_page(self, m, query):
+            page = owner[m.group(1)].by_id[m.group(1)] if m.group(1) in owner else None
+            if page is None:
+                return self.send_json("page", {"message": "not found"}, 404)
+            self.send_json("page", space.page_json(page, query.get("expand", "") + ",version"))
+
+        def get_download(self, m, query):
+            page = owner[m.group(1)].by_id[m.group(1)] if m.group(1) in owner else None
+            name = unquote(m.group(2))
+            att = next((a for a in page["attachments"] if a["title"] == name), None) if page else None
+            if att is None:
+                return self.send_json("download", {}, 404)
+            data = att["data"]
+            code = 200
+            headers = {"Accept-Ranges": "bytes"}
+            rng = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+            if rng:
+                offset = int(rng.group(1))
+                if offset >= len(data):
+                    return self.send_body(416, b"", "application/octet-stream")
+                headers["Content-Range"] = f"bytes {offset}-{len(data) - 1}/{len(data)}"
+                data = data[offset:]
+                code = 206
+            stats.add("download", len(data))
+            self.send_body(code, data, "application/octet-stream", headers)
+
+    Handler.space = space
+    Handler.stats = stats
+    return Handler
+
+
+def url_without_start(path):
+    return re.sub(r"&start=\d+", "", path)
+
+
+def serve(space, port=0, **options):
+    """Запускает заглушку в фоновом потоке; возвращает сервер (адрес — server.server_address)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(space, **options))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_space_args(parser):
+    parser.add_argument("--pages", type=int, default=200, help="Число страниц в пространстве")
+    parser.add_argument("--depth", type=int, default=4, help="Глубина дерева страниц")
+    parser.add_argument("--body-kb", type=int, default=8, help="Размер тела страницы, КБ")
+    parser.add_argument("--attachments", type=int, default=2, help="Вложений на страницу")
+    parser.add_argument("--attachment-kb", type=int, default=64, help="Размер вложения, КБ")
+    parser.add_argument("--no-shared-attachment", action="store_true",
+                        help="Не класть одинаковый logo.png на каждую страницу")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Задержка каждого ответа, мс")
+    parser.add_argument("--rate-429", type=float, default=0, help="Доля ответов 429 (0..1)")
+    parser.add_argument("--total-size", action="store_true", help="Отдавать totalSize в листингах")
+    parser.add_argument("--search", action="store_true", help="Отвечать на CQL-поиск числа страниц (/rest/api/search)")
+    parser.add_argument("--etag", action="store_true", help="Отдавать ETag и 304 на If-None-Match")
+    parser.add_argument("--title-words", type=int, default=0,
+                        help="Длинные заголовки из стольких повторов фразы (и одноимённые соседи) — проверка путей")
+
+
+def space_from_args(args, key=SPACE_KEY, first_id=100000):
+    return MockSpace(pages=args.pages, depth=args.depth, body_kb=args.body_kb, attachments=args.attachments,
+                     attachment_kb=args.attachment_kb, shared_attachment=not args.no_shared_attachment,
+                     key=key, first_id=first_id, title_words=args.title_words)
+
+
+def server_options(args):
+    return {"latency": args.latency_ms / 1000, "rate_429": args.rate_429, "total_size": args.total_size,
+            "search": args.search, "etag": args.etag}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка REST API Confluence")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--spaces", type=int, default=1, help="Сколько пространств: ISE, SP2, SP3, ...")
+    add_space_args(parser)
+    args = parser.parse_args()
+    spaces = [space_from_args(args)] + [space_from_args(args, f"SP{k}", 100000 * k) for k in range(2, args.spaces + 1)]
+    server = serve(spaces, args.port, **server_options(args))
+    host, port = server.server_address
+    for space in spaces:
+        print(f"Заглушка Confluence: http://{host}:{port}/wiki (пространство {space.key}, "
+              f"корневая страница {space.pages[0]['id']})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,165 +1,635 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
 import re
+import threading
+import time
+import sys
 import requests
 import urllib3
-from bs4 import BeautifulSoup
+from functools import partial
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from itertools import chain
+from urllib.parse import unquote, unquote_plus, urlparse
+
+from attachment_downloader import TransferPool, attachment_size, download_file, part_path, stream_file
+from blob_store import BlobStore
+from confluence_http import add_limiter_args, configure_limiter
+from export_archive import TREE_NAME, open_archive, spool_chunks
+from html_rewrite import iter_rewrite
+from page_model import PageTable
+from page_tree import PageTree, relative_link
+from path_allocator import PathAllocator, add_path_args
+from response_cache import add_cache_args, close_cache, configure_cache, get_json, is_offline
+from export_metrics import METRICS, add_metrics_args, report
+from search_index import SearchIndex
+from storage_render import render_storage
+from thumbnails import Thumbnailer, available as thumbnails_available
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 BASE_URL = "https://sberworks.ru/wiki"
 SPACE_KEY = "ISE"
 MAX_PAGES = 2000  # ограничение на количество выгруженных страниц для тестов
+BODY_WINDOW = 50  # сколько тел страниц запрашивать за один запрос листинга
+RETRY_ROUNDS = 3  # сколько раз повторять упавшие страницы после основного прохода
+RETRY_BASE_DELAY = 30  # сек; пауза перед повтором растёт как 30, 60, 120...
+BODY_FORMAT = "view"  # "storage" при --local-render: макросы рисуются здесь, а не на сервере
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Экспорт пространства Confluence в HTML с меню и вложениями")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Сколько страниц выгружать параллельно (1 = последовательно)")
+    parser.add_argument("--menu", choices=["inline", "external"], default="inline",
+                        help="inline — меню встраивается в каждую страницу, "
+                             "external — дерево пишется один раз в export/menu.js")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Перерисовать только страницы, изменившиеся с прошлого запуска (по export/manifest.json)")
+    parser.add_argument("--render-processes", type=int, default=0,
+                        help="Рисовать страницы (ссылки, меню, запись) в стольких отдельных процессах, "
+                             "а потоки --workers оставить на сеть (0 = рисовать в тех же потоках)")
+    parser.add_argument("--local-render", action="store_true",
+                        help="Брать тела в body.storage и рисовать их здесь, а не на сервере; body.view — "
+                             "только для страниц с макросами, которые локально не отрисовать")
+    parser.add_argument("--download-workers", type=int, default=4,
+                        help="Сколько вложений качать параллельно (1 = по одному)")
+    parser.add_argument("--dedupe-attachments", action="store_true",
+                        help="Хранить вложения один раз по содержимому в export/_blobs и ссылаться на них жёсткими ссылками")
+    parser.add_argument("--resume", action="store_true",
+                        help="Продолжить прерванный запуск с места, записанного в export/.checkpoint.jsonl")
+    parser.add_argument("--search-index", action="store_true",
+                        help="Построить полнотекстовый индекс в export/_search и страницу поиска export/search.html")
+    parser.add_argument("--listing-workers", type=int, default=4,
+                        help="Сколько окон листинга запрашивать параллельно, если сервер отдаёт totalSize")
+    parser.add_argument("--listing-limit", type=int, default=200,
+                        help="Размер окна лёгкого листинга (id, заголовки, предки, версии)")
+    parser.add_argument("--archive",
+                        help="Писать выгрузку не в export/, а в один архив: export.zip, export.tar или export.sqlite")
+    parser.add_argument("--thumbnails", action="store_true",
+                        help="Показывать в страницах уменьшенные копии больших картинок (export/_previews, нужен Pillow)")
+    parser.add_argument("--thumbnail-size", type=int, default=1280,
+                        help="Наибольшая сторона превью, пикселей")
+    parser.add_argument("--thumbnail-processes", type=int, default=0,
+                        help="Сколько процессов пережимают картинки (0 = по числу ядер)")
+    add_path_args(parser)
+    add_limiter_args(parser)
+    add_cache_args(parser)
+    add_metrics_args(parser)
+    args = parser.parse_args(argv)
+    if args.archive and (args.incremental or args.resume or args.dedupe_attachments or args.search_index
+                         or args.thumbnails):
+        parser.error("--archive пишется с нуля: несовместим с --incremental, --resume, --dedupe-attachments, "
+                     "--search-index и --thumbnails")
+    return args
+
+SHARED_SESSION = None  # пакетный режим (batch_export.py): одна сессия с общим пулом соединений на все потоки
 
 def get_session():
+    if SHARED_SESSION is not None:
+        return SHARED_SESSION
     s = requests.Session()
     s.auth = (os.environ['UNAME'], os.environ['PASSWD'])
     s.verify = False
     s.cert = os.environ['CERT_PATH']
     return s
 
-def get_all_pages(session):
-    pages = []
+# ---------- ПАРАЛЛЕЛЬНАЯ ВЫГРУЗКА ----------
+
+_local = threading.local()
+
+def worker_session():
+    """Своя сессия (и пул соединений) на каждый поток-воркер."""
+    if not hasattr(_local, "session"):
+        _local.session = get_session()
+    return _local.session
+
+_stats_lock = threading.Lock()
+STATS = {"pages": 0, "attachments": 0, "bytes": 0, "local_render": 0, "view_fallback": 0}
+FALLBACK_REASONS = {}  # {что не отрисовалось локально: сколько страниц}
+
+def count_stat(key, n=1):
+    with _stats_lock:
+        STATS[key] += n
+
+def fetch_listing_window(session, expand, limit, start):
+    url = f"{BASE_URL}/rest/api/content?spaceKey={SPACE_KEY}&limit={limit}&start={start}&expand={expand}"
+    data = get_json(session, url)
+    if data is None:
+        raise requests.HTTPError(f"404 for {url}")
+    return data
+
+def space_total(session):
+    """Число страниц пространства одним дешёвым CQL-поиском (None, если сервер его не отдал)."""
+    try:
+        data = get_json(session, f"{BASE_URL}/rest/api/search",
+                        params={"cql": f'space="{SPACE_KEY}" and type=page', "limit": 0})
+    except requests.HTTPError:
+        return None
+    return data.get("totalSize") if data is not None else None
+
+def iter_listing(session, expand, limit, checkpoint=None, workers=1, total=None):
+    """Окна листинга /rest/api/content пространства — по одному ответу за раз, по порядку.
+
+    Если известно число страниц (total, totalSize первого ответа или
+    space_total), остальные окна известны заранее и запрашиваются параллельно (до workers одновременно, столько же ждут
+    очереди — дальше вперёд не забегаем, чтобы не копить тела в памяти).
+    Без totalSize идём последовательно по _links.next. Шаг берётся из limit
+    ответа: сервер вправе урезать запрошенный. Пройденные окна записываются
+    в checkpoint; при --resume они берутся из журнала.
+    """
+    def window(s, start):
+        if checkpoint is not None and start in checkpoint.listing:
+            return checkpoint.listing[start]
+        return fetch_listing_window(s, expand, limit, start)
+
+    def done(start, data):
+        if checkpoint is not None and start not in checkpoint.listing:
+            checkpoint.listing_done(start, data)
+
+    data = window(session, 0)
+    done(0, data)
+    step = data.get("limit") or limit
+    if total is None:
+        total = data.get("totalSize")
+    if total is None and workers > 1 and "next" in data.get("_links", {}):
+        total = space_total(session)
     start = 0
-    limit = 50
+    if total is not None and workers > 1 and total > step:
+        if data["results"]:
+            yield data["results"]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            starts = iter(range(step, total, step))
+            for start in starts:
+                pending.append((start, pool.submit(lambda st: window(worker_session(), st), start)))
+                if len(pending) >= 2 * workers:
+                    break
+            try:
+                while pending:
+                    start, fut = pending.popleft()
+                    data = fut.result()
+                    done(start, data)
+                    if data["results"]:
+                        yield data["results"]
+                    for nxt in starts:
+                        pending.append((nxt, pool.submit(lambda st: window(worker_session(), st), nxt)))
+                        break
+            finally:
+                # потребитель остановился раньше (MAX_PAGES) — очередь не докачиваем
+                for _, fut in pending:
+                    fut.cancel()
+        # пространство выросло, пока шёл листинг, — хвост дочитываем по _links.next
+        if not data["results"] or "next" not in data.get("_links", {}):
+            return
+        start += step
+        data = window(session, start)
+        done(start, data)
+
     while True:
-        url = f"{BASE_URL}/rest/api/content?spaceKey={SPACE_KEY}&limit={limit}&start={start}&expand=body.view,ancestors"
-        r = session.get(url)
-        r.raise_for_status()
-        data = r.json()
-        results = data["results"]
-        if not results:
+        if not data["results"]:
+            break
+        yield data["results"]
+        if "next" not in data.get("_links", {}):
             break
+        start += step
+        data = window(session, start)
+        done(start, data)
+
+def get_all_pages(session, checkpoint=None, limit=200, workers=1):
+    """Первый, лёгкий проход: id, заголовки, предки и версии страниц — без тел.
+
+    Этого хватает на пути и дерево меню, а память не зависит от объёма текста.
+    Возвращает PageTable: от ответов листинга остаются только компактные записи;
+    пути им проставляет page_tree.
+    """
+    pages = PageTable()
+    for results in iter_listing(session, "ancestors,version", limit, checkpoint, workers):
         pages.extend(results)
         if len(pages) >= MAX_PAGES:
-            pages = pages[:MAX_PAGES]
-            break
-        if "_links" in data and "next" in data["_links"]:
-            start += limit
-        else:
+            pages.truncate(MAX_PAGES)
             break
     return pages
 
-def get_page_path(page):
-    parts = [a["title"].replace("/", "_") for a in page.get("ancestors", [])]
-    parts.append(page["title"].replace("/", "_"))
-    return os.path.join("export", *parts)
+def iter_pages_with_bodies(session, todo, total, workers=1):
+    """Второй проход: страницы из todo вместе с телами, окно за окном.
+
+    В памяти одновременно держится не больше окна тел (и того, что сейчас
+    пишут воркеры). Если страниц мало относительно всего пространства,
+    дешевле запросить каждое тело отдельно — это сделает fetch_page.
+    """
+    if len(todo) <= total / BODY_WINDOW:
+        yield from todo
+        return
+
+    wanted = {p.id: p for p in todo}
+    for results in iter_listing(session, f"body.{BODY_FORMAT},version", BODY_WINDOW, workers=workers, total=total):
+        for p in results:
+            record = wanted.pop(p["id"], None)
+            if record is not None:
+                record.body = p["body"][BODY_FORMAT]["value"]
+                record.version = page_version(p) or record.version
+                yield record
+        if not wanted:
+            return
+    # страницы, сдвинувшиеся в листинге между проходами, докачаются по одной
+    yield from wanted.values()
+
+def fetch_page_body(session, page, representation="view"):
+    url = f"{BASE_URL}/rest/api/content/{page.id}?expand=body.{representation}"
+    # тело той же версии не меняется — из HTTP-кэша его можно брать без запроса
+    data = get_json(session, url, version=page.version)
+    return data["body"][representation]["value"] if data else None
+
+def page_html(session, page):
+    """HTML тела страницы (None, если её удалили после листинга).
+
+    Тело, пришедшее окном листинга, забирается из записи страницы — дальше
+    его держит только задание на отрисовку. С --local-render тело приходит в
+    body.storage и рисуется здесь (storage_render); body.view запрашивается
+    только для страниц, где есть то, что локально не отрисовать.
+    """
+    value, page.body = page.body, None
+    if value is None:
+        # тело не пришло окном листинга — запрашиваем отдельно
+        with METRICS.phase("bodies"):
+            value = fetch_page_body(session, page, BODY_FORMAT)
+    if BODY_FORMAT == "view" or value is None:
+        return value
+
+    with METRICS.phase("storage_render"):
+        html, reason = render_storage(value, page.id, SPACE_KEY, urlparse(BASE_URL).path)
+    if html is not None:
+        count_stat("local_render")
+        return html
+    count_stat("view_fallback")
+    with _stats_lock:
+        FALLBACK_REASONS[reason] = FALLBACK_REASONS.get(reason, 0) + 1
+    with METRICS.phase("bodies"):
+        return fetch_page_body(session, page, "view")
+
+def print_render_summary():
+    top = sorted(FALLBACK_REASONS.items(), key=lambda kv: -kv[1])[:5]
+    reasons = ", ".join(f"{reason}: {n}" for reason, n in top)
+    print(f"Отрисовано локально: {STATS['local_render']}, взято в body.view: {STATS['view_fallback']}"
+          + (f" ({reasons})" if reasons else ""))
+
+def page_version(page):
+    return page.get("version", {}).get("number")
+
+PATHS_FILE = "paths.json"  # карта id -> путь в export/, см. path_allocator
+# что выгрузка пишет в корень export/ сама: корневая страница с таким сегментом затёрла бы его
+# (index -> index.html, search -> search.html) или легла бы в чужой каталог (_blobs, _search, ...)
+ROOT_NAMES = ("index", "search", "menu.js", "manifest.json", PATHS_FILE, ".checkpoint.jsonl", "_blobs", "_search",
+              "_previews", "attachments", TREE_NAME)
+
+def path_allocator(args, root="."):
+    """PathAllocator по аргументам; карта прошлого запуска — root/export/paths.json (в архивном режиме не хранится)."""
+    map_path = None if args.archive else os.path.join(root, "export", PATHS_FILE)
+    # к пути дописываются .html, а при записи ещё и .tmp
+    return PathAllocator(map_path, args.max_name_bytes, args.max_path_bytes, args.flat_paths, len(".html.tmp"),
+                         ROOT_NAMES)
+
+def page_tree(pages, allocator=None):
+    """PageTree по листингу; заодно проставляет записям пути export/<путь от allocator> (без .html).
+
+    Пути раздаются всем страницам сразу, до выгрузки: одноимённые соседи
+    не затирают друг друга, а параллельные потоки не спорят за файлы.
+    """
+    tree = PageTree.from_pages(pages)
+    paths = (allocator or PathAllocator(reserve=len(".html.tmp"), reserved=ROOT_NAMES)).place_tree(tree)
+    for page in pages:
+        page.path = os.path.join("export", *paths[page.id])
+    return tree
+
+def attachments_dir(page):
+    """Каталог вложений страницы относительно её каталога: attachments/<id>.
+
+    У каждой страницы свой: имена вложений вроде image.png у соседних страниц
+    совпадают, а в общем каталоге все они показывали бы один файл.
+    """
+    return os.path.join("attachments", page.id)
+
+def skip_offline(download_link):
+    """--offline: вложения нет ни на диске, ни в кэше — пропускаем, а не роняем страницу (повтор не поможет)."""
+    if is_offline():
+        print(f"⚠️ --offline: вложения нет от прошлой выгрузки, пропускаю: {download_link}")
+        return True
+    return False
 
-def download_attachments(session, page, page_dir):
-    url = f"{BASE_URL}/rest/api/content/{page['id']}/child/attachment?limit=1000"
-    r = session.get(url)
-    r.raise_for_status()
-    attachments = r.json().get("results", [])
+def fetch_attachment(session, download_link, full_path, expected_size=None, version=None):
+    if skip_offline(download_link):
+        return False
+    # download_file пишет через .part и переименование: после падения не останется
+    # недокачанного файла, который os.path.exists примет за готовый
+    received = download_file(session, download_link, full_path, expected_size, version)
+    if received is None:
+        print(f"⚠️ Вложение не найдено (404): {download_link}")
+        return False
+    count_stat("attachments")
+    count_stat("bytes", received)
+    return True
 
-    attach_dir = os.path.join(page_dir, "attachments")
-    os.makedirs(attach_dir, exist_ok=True)
+def archive_attachment(session, download_link, full_path, archive, expected_size=None):
+    """Скачивает вложение прямо в архив (уже записанное под этим именем — пропускает)."""
+    if skip_offline(download_link):
+        return False
+    entry = archive.open(archive_name(full_path))
+    if entry is None:
+        return False
+    with entry:
+        received = stream_file(session, download_link, entry, expected_size)
+        if received is None:
+            entry.discard()
+            print(f"⚠️ Вложение не найдено (404): {download_link}")
+            return False
+    count_stat("attachments")
+    count_stat("bytes", received)
+    return True
+
+def save_attachment(session, att, full_path, store=None, archive=None):
+    """Скачивает одно вложение в full_path (или в архив), если там его ещё нет."""
+    download_link = BASE_URL + att["_links"]["download"]
+    expected = attachment_size(att)
+    version = page_version(att)
+    if archive is not None:
+        archive_attachment(session, download_link, full_path, archive, expected)
+        return
+
+    if os.path.exists(full_path) and expected is not None and os.path.getsize(full_path) != expected:
+        os.remove(full_path)  # битый файл от старого запуска
+    if os.path.exists(full_path):
+        return
+    if store is None:
+        fetch_attachment(session, download_link, full_path, expected, version)
+        return
+    key = f"{att['id']}:{version}" if version is not None else None
+    store.fetch(key, lambda tmp: fetch_attachment(session, download_link, tmp, expected, version), full_path)
+
+def download_attachments(session, page, page_dir, known=None, store=None, transfers=None, archive=None):
+    """Скачивает вложения страницы.
+
+    known — {id вложения: {"version", "file"}} из манифеста: вложение той же
+    версии повторно не качается, а новая версия перезаписывает старый файл.
+    store — BlobStore: файлы берутся из общего хранилища по содержимому.
+    transfers — TransferPool: вложения страницы качаются параллельно.
+    archive — писатель export_archive: вложения идут в архив, а не на диск.
+    Возвращает ({download-ссылка: локальный путь}, записи для манифеста).
+    """
+    known = known or {}
+    url = f"{BASE_URL}/rest/api/content/{page.id}/child/attachment?limit=1000&expand=version"
+    data = get_json(session, url)
+    attachments = data.get("results", []) if data else []
+
+    local_dir = attachments_dir(page)
+    if archive is None:
+        os.makedirs(os.path.join(page_dir, local_dir), exist_ok=True)
 
     mapping = {}  # {original_download_url: relative_local_path}
+    records = {}  # {attachment_id: {"version": ..., "file": ...}}
+    jobs = []
 
     for att in attachments:
         fname = att["title"].replace("/", "_")
-        download_link = BASE_URL + att["_links"]["download"]
 
-        local_path = os.path.join("attachments", fname)
-        full_path = os.path.join(page_dir, "attachments", fname)
+        local_path = os.path.join(local_dir, fname)
+        full_path = os.path.join(page_dir, local_path)
 
-        if not os.path.exists(full_path):
-            resp = session.get(download_link, stream=True)
-            resp.raise_for_status()
-            with open(full_path, "wb") as f:
-                for chunk in resp.iter_content(8192):
-                    f.write(chunk)
+        version = page_version(att)
+        prev = known.get(att["id"])
+        if prev and prev["file"] == full_path and prev["version"] != version:
+            # вложение обновилось — качаем заново; обрывок старой версии не продолжаем
+            for stale in (full_path, part_path(full_path, prev["version"])):
+                if os.path.exists(stale):
+                    os.remove(stale)
+        records[att["id"]] = {"version": version, "file": full_path}
 
+        jobs.append(partial(save_attachment, att=att, full_path=full_path, store=store, archive=archive))
         mapping[att["_links"]["download"]] = local_path
 
-    return mapping
+    if transfers is None:
+        for job in jobs:
+            job(session)
+    else:
+        transfers.run(jobs)
 
-def rewrite_links(html, pageid_to_path, attachments_map, current_path):
-    soup = BeautifulSoup(html, "html.parser")
+    return mapping, records
 
-    # Переписываем ссылки на страницы
-    for a in soup.find_all("a", href=True):
-        href = a["href"]
-        m = re.search(r"pageId=(\d+)", href)
-        if m:
-            pid = m.group(1)
-            if pid in pageid_to_path:
-                a["href"] = os.path.relpath(pageid_to_path[pid], os.path.dirname(current_path))
+# ---------- ПЕРЕПИСЫВАНИЕ ССЫЛОК ----------
+
+PAGE_ID_RE = re.compile(r"pageId=(\d+)")
+DISPLAY_RE = re.compile(r"/display/([^/?#]+)/([^?#]+)")
+ATTACHMENT_RE = re.compile(r"/download/(?:attachments|thumbnails)/(\d+/[^?#]+)")
+
+def attachment_key(url):
+    """Ключ вложения "<id страницы>/<имя файла>": без query, %-кодирования и разницы attachments/thumbnails."""
+    m = ATTACHMENT_RE.search(url)
+    return unquote(m.group(1)) if m else None
 
-    # Переписываем ссылки на вложения
-    for tag in soup.find_all(["img", "a"]):
-        for attr in ["src", "href"]:
-            if tag.has_attr(attr):
-                val = tag[attr]
-                for orig, new in attachments_map.items():
-                    if val.endswith(orig):
-                        tag[attr] = new
+def linked_page_id(href, title_to_id):
+    """id страницы, на которую ведёт ссылка вида ?pageId=123 или /display/SPACE/Title."""
+    m = PAGE_ID_RE.search(href)
+    if m:
+        return m.group(1)
+    m = DISPLAY_RE.search(href)
+    if m and title_to_id:
+        return title_to_id.get((m.group(1), unquote_plus(m.group(2))))
+    return None
 
-    return str(soup)
+def rewrite_links(html, pageid_to_path, attachments_map, current_path, linked=None, title_to_id=None, text=None,
+                  previews=None):
+    """Переписывает ссылки на страницы и вложения на локальные за один проход, без разбора в дерево.
+
+    Возвращает итератор кусков HTML (html_rewrite.iter_rewrite): остальная
+    разметка не меняется ни на байт. linked и text заполняются по мере
+    прохода — читать их можно, только когда куски выбраны до конца.
+    title_to_id — {(ключ пространства, заголовок): id} для ссылок /display/SPACE/Title.
+    linked — если передан, в него складываются id всех страниц, на которые ссылается html.
+    text — если передан список, в него добавляется текст страницы (для поискового индекса).
+    previews — {локальный путь вложения: путь превью}: <img> показывает превью и ведёт на оригинал.
+    """
+    previews = previews or {}
+    local_attachments = {attachment_key(orig): new for orig, new in attachments_map.items()}
+    local_attachments.pop(None, None)
+    current_dir = os.path.dirname(current_path)
+
+    def rewrite(tag, attr, val):
+        if not val:
+            return None
+        key = attachment_key(val)
+        if key in local_attachments:
+            local = local_attachments[key]
+            if tag == "img" and local in previews:
+                return previews[local], local
+            return local
+        if attr != "href":
+            return None
+        pid = linked_page_id(val, title_to_id)
+        if pid is None:
+            return None
+        if linked is not None:
+            linked.add(pid)
+        if pid in pageid_to_path:
+            return relative_link(pageid_to_path[pid], current_dir)
+        return None
+
+    return iter_rewrite(html, rewrite, text)
 
 # ---------- ЛОКАЛЬНОЕ МЕНЮ СЛЕВА ДЛЯ КАЖДОЙ СТРАНИЦЫ ----------
 
-def menu_build_tree(node, pages, pageid_to_path, current_page_id=None, relroot="export"):
-    """Строит HTML-дерево (<details>/<summary>) с ссылками, относительными к relroot."""
-    html = ""
-    for pid, children in node.items():
-        title = next(p["title"] for p in pages if p["id"] == pid)
-        link = os.path.relpath(pageid_to_path[pid], relroot)
-        if pid == current_page_id:
-            link_html = f"<b>{title}</b>"
-        else:
-            link_html = f"<a href='{link}'>{title}</a>"
-
-        if children:
-            html += f"<details><summary>{link_html}</summary>{menu_build_tree(children, pages, pageid_to_path, current_page_id, relroot)}</details>"
-        else:
-            html += f"<li>{link_html}</li>"
-    return html
-
-def build_menu_html(pages, pageid_to_path, current_page_id=None, relroot="export"):
-    """Возвращает HTML меню для вставки в каждую страницу."""
-    tree = {}
-    for p in pages:
-        ancestors = [a["id"] for a in p.get("ancestors", [])]
-        node = tree
-        for aid in ancestors:
-            node = node.setdefault(aid, {})
-        node[p["id"]] = {}
+MENU_PREFIX = "\x00"  # в шаблоне меню заменяется на "../" * глубина текущей страницы
+
+class NavMenu:
+    """Меню (<details>/<summary>), отрендеренное один раз.
+
+    Ссылки в шаблоне идут относительно export/ с маркером MENU_PREFIX, поэтому
+    для каждой страницы остаётся подставить префикс и выделить текущий пункт —
+    линейно от размера меню, без повторного обхода дерева.
+    """
+
+    def __init__(self, tree, pageid_to_path):
+        self.tree = tree
+        self.anchors = {}
+        parts = []
+        self.nodes = self._render(tree.roots, pageid_to_path, parts)
+        self.template = "".join(parts)
+
+    def _render(self, indexes, pageid_to_path, parts):
+        """Дописывает HTML в parts и возвращает те же узлы дерева в виде [id, title, href, [дети]]."""
+        nodes = []
+        for i in indexes:
+            pid = self.tree.ids[i]
+            title = self.tree.title[i]
+            children = self.tree.children[i]
+            href = None
+            if pid in pageid_to_path:
+                href = relative_link(pageid_to_path[pid], "export")
+                link_html = f"<a href='{MENU_PREFIX}{href}'>{title}</a>"
+                self.anchors[pid] = link_html
+            else:
+                # предок, не попавший в выгрузку (например, из-за MAX_PAGES)
+                link_html = title
 
+            if children:
+                parts.append(f"<details><summary>{link_html}</summary>")
+                kids = self._render(children, pageid_to_path, parts)
+                parts.append("</details>")
+            else:
+                parts.append(f"<li>{link_html}</li>")
+                kids = []
+            nodes.append([pid, title, href and href.replace(os.sep, "/"), kids])
+        return nodes
+
+    def render(self, current_page_id=None, relroot="export"):
+        """HTML дерева со ссылками относительно relroot и выделенной текущей страницей."""
+        html = self.template
+        anchor = self.anchors.get(current_page_id)
+        if anchor:
+            html = html.replace(anchor, f"<b>{self.tree.title[self.tree.index[current_page_id]]}</b>", 1)
+        return html.replace(MENU_PREFIX, relative_prefix(relroot))
+
+def relative_prefix(relroot):
+    """Префикс "../../", ведущий из каталога relroot обратно в export/."""
+    rel = relative_link(relroot, "export")
+    if rel == os.curdir:
+        return ""
+    return (os.pardir + os.sep) * (rel.count(os.sep) + 1)
+
+def build_menu_html(menu, current_page_id=None, relroot="export", external=False):
+    """Возвращает HTML меню для вставки в каждую страницу.
+
+    При external=True в страницу попадает только заглушка и ссылка на
+    export/menu.js, дерево дорисовывается в браузере.
+    """
+    if external:
+        prefix = relative_prefix(relroot).replace(os.sep, "/")
+        return f"""
+    <div id="menu">
+      <h2>Навигация</h2>
+    </div>
+    <script>var MENU_PREFIX = {json.dumps(prefix)}, MENU_CURRENT = {json.dumps(current_page_id)};</script>
+    <script src="{prefix}menu.js"></script>
+    """
     return f"""
     <div id="menu">
       <h2>Навигация</h2>
-      {menu_build_tree(tree, pages, pageid_to_path, current_page_id, relroot)}
+      {menu.render(current_page_id, relroot)}
     </div>
     """
 
-def save_page_html(session, page, pageid_to_path, pages):
-    path = get_page_path(page)
-    page_dir = os.path.dirname(path)
-    os.makedirs(page_dir, exist_ok=True)
+# Рисует то же дерево, что и NavMenu.render, но на стороне браузера.
+# Подключается как <script src>, а не через fetch, чтобы работать и с file://.
+MENU_JS = """
+(function () {
+  function esc(s) {
+    return String(s).replace(/[&<>"']/g, function (c) {
+      return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"}[c];
+    });
+  }
+  function render(nodes, out) {
+    for (var i = 0; i < nodes.length; i++) {
+      var id = nodes[i][0], title = esc(nodes[i][1]), href = nodes[i][2], kids = nodes[i][3];
+      var link;
+      if (id === MENU_CURRENT) link = "<b>" + title + "</b>";
+      else if (href === null) link = title;
+      else link = "<a href='" + esc(MENU_PREFIX + href) + "'>" + title + "</a>";
+      if (kids.length) {
+        out.push("<details><summary>", link, "</summary>");
+        render(kids, out);
+        out.push("</details>");
+      } else {
+        out.push("<li>", link, "</li>");
+      }
+    }
+  }
+  var out = [];
+  render(MENU_TREE, out);
+  document.getElementById("menu").insertAdjacentHTML("beforeend", out.join(""));
+})();
+"""
 
-    # Скачиваем вложения
-    attachments_map = download_attachments(session, page, page_dir)
+def archive_name(path):
+    """Имя файла в архиве: путь относительно export/."""
+    return relative_link(path, "export")
 
-    html_content = page["body"]["view"]["value"]
+def write_menu_asset(menu, archive=None):
+    """Пишет дерево навигации один раз в export/menu.js (или в архив)."""
+    text = "var MENU_TREE = " + json.dumps(menu.nodes, ensure_ascii=False, separators=(",", ":")) + ";\n" + MENU_JS
+    if archive is not None:
+        archive.write_text("menu.js", text)
+        return
+    with open("export/menu.js", "w", encoding="utf-8") as f:
+        f.write(text)
 
-    current_path = path + ".html"
+CONTENT_MARKER = "\x01"  # место тела страницы в шаблоне
 
-    # Переписываем ссылки
-    html_content = rewrite_links(html_content, pageid_to_path, attachments_map, current_path)
+def encode_chunks(chunks, digest):
+    """Кодирует куски страницы в UTF-8, попутно считая sha256 всей страницы."""
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        digest.update(data)
+        yield data
 
-    # Добавляем локальное меню слева (ссылки относительно текущей страницы)
-    menu_html = build_menu_html(
-        pages, pageid_to_path,
-        current_page_id=page["id"],
-        relroot=os.path.dirname(current_path)
-    )
+def write_page(path, chunks, previous=None, digest=None):
+    """Пишет страницу кусками через .tmp; если она не изменилась с прошлого запуска, файл не трогается."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for data in chunks:
+            f.write(data)
+    if same_as_previous(previous, path, digest.hexdigest()):
+        os.remove(tmp)
+    else:
+        os.replace(tmp, path)
 
-    # Оборачиваем в двухколоночный layout с меню слева
+def page_layout(title, menu_html):
+    """Двухколоночный layout с меню слева: (начало страницы, конец), тело идёт между ними."""
     wrapped = f"""
     <html>
       <head>
         <meta charset="utf-8">
-        <title>{page['title']}</title>
+        <title>{title}</title>
         <style>
           body {{
             margin: 0;
@@ -185,74 +655,564 @@ def save_page_html(session, page, pageid_to_path, pages):
       <body>
         {menu_html}
         <div id="content">
-          {html_content}
+          {CONTENT_MARKER}
         </div>
       </body>
     </html>
     """
+    return wrapped.split(CONTENT_MARKER)
+
+def fetch_page(session, page, manifest=None, store=None, transfers=None, search=None, archive=None,
+               thumbs=None):
+    """Сетевая часть выгрузки страницы: вложения и тело.
+
+    Возвращает задание для render_page (только строки и словари — его можно
+    отдать в другой процесс) или None, если страницу удалили после листинга.
+    """
+    path = page.path
+    page_dir = os.path.dirname(path)
+    if archive is None:
+        os.makedirs(page_dir, exist_ok=True)
+
+    # Скачиваем вложения
+    known = manifest.previous_attachments(page.id) if manifest else None
+    with METRICS.phase("attachments"):
+        attachments_map, attachment_records = download_attachments(session, page, page_dir, known, store,
+                                                                   transfers, archive)
 
-    with open(current_path, "w", encoding="utf-8") as f:
-        f.write(wrapped)
+    html_content = page_html(session, page)
+    if html_content is None:
+        return None  # страницу удалили после листинга
 
+    previews = {}
+    if thumbs is not None:
+        with METRICS.phase("thumbnails"):
+            for local in set(attachments_map.values()):
+                preview = thumbs.preview(os.path.join(page_dir, local))
+                if preview is not None:
+                    previews[local] = relative_link(preview, page_dir)
+
+    return {
+        "id": page.id,
+        "title": page.title,
+        "path": path + ".html",
+        "html": html_content,
+        "attachments": attachments_map,
+        "previews": previews,
+        "records": attachment_records,
+        "previous": manifest.previous.get(page.id) if manifest else None,
+        "search": search is not None,
+        "archive": archive is not None,
+    }
+
+def render_page(job, state):
+    """Вычислительная часть: ссылки, меню и запись страницы на диск (в архивном режиме — в байты).
+
+    state — {"link_paths", "menu", "title_to_id", "external_menu"}, общее для всех страниц.
+    Возвращает {"digest", "linked", "text", "data", "spool"} (data/spool — страница для архива, см. spool_chunks).
+    """
+    current_path = job["path"]
+
+    # Ссылки переписываются потоком прямо при записи страницы
+    linked = set()
+    text = [] if job["search"] else None
+    content = rewrite_links(job["html"], state["link_paths"], job["attachments"], current_path, linked,
+                            state["title_to_id"], text, job["previews"])
+
+    # Добавляем локальное меню слева (ссылки относительно текущей страницы)
+    with METRICS.phase("build_menu_html"):
+        menu_html = build_menu_html(
+            state["menu"],
+            current_page_id=job["id"],
+            relroot=os.path.dirname(current_path),
+            external=state["external_menu"]
+        )
+    head, tail = page_layout(job["title"], menu_html)
+
+    digest = hashlib.sha256()
+    chunks = encode_chunks(chain((head,), content, (tail,)), digest)
+    data = spool = None
+    if job["archive"]:
+        # архив один на процесс выгрузки — пишет его finish_page (фаза write); большая
+        # страница ждёт его во временном файле, а не в памяти
+        with METRICS.phase("rewrite_links"):
+            data, spool = spool_chunks(chunks)
+    else:
+        # ссылки переписываются потоком прямо при записи: время выдачи кусков — rewrite_links,
+        # запись и переименование .tmp — write
+        with METRICS.streamed_phase("write", "rewrite_links", chunks) as chunks:
+            write_page(current_path, chunks, job["previous"], digest)
+    return {"digest": digest.hexdigest(), "linked": linked, "text": text[0] if text else None, "data": data,
+            "spool": spool}
+
+def finish_page(page, job, result, manifest=None, search=None, archive=None):
+    """Учёт отрисованной страницы: архив, поисковый индекс, манифест; возвращает путь к .html."""
+    current_path = job["path"]
+    if archive is not None:
+        with METRICS.phase("write"):
+            if result["spool"] is not None:
+                archive.write_file(archive_name(current_path), result["spool"])
+            else:
+                archive.write_bytes(archive_name(current_path), (result["data"],))
+        archive.add_page(page.id, page.title, page.parent, archive_name(current_path))
+    if search is not None:
+        with METRICS.phase("search_index"):
+            search.add(page.id, page.title, relative_link(current_path, "export"), result["text"])
+    if manifest is not None:
+        manifest.record(page, current_path, result["digest"], job["records"], result["linked"])
+
+    count_stat("pages")
     return current_path
 
-def generate_index(pages, pageid_to_path):
-    tree = {}
+def save_page_html(session, page, state, manifest=None, store=None, transfers=None, search=None,
+                   archive=None, thumbs=None):
+    """Сохраняет страницу и её вложения в текущем потоке; возвращает путь к .html или None, если страницы уже нет."""
+    job = fetch_page(session, page, manifest, store, transfers, search, archive, thumbs)
+    if job is None:
+        return None
+    return finish_page(page, job, render_page(job, state), manifest, search, archive)
+
+# ---------- ОТДЕЛЬНЫЕ ПРОЦЕССЫ ДЛЯ ОТРИСОВКИ ----------
+
+RENDER_STATE = {}  # state для render_page в процессе отрисовки; передаётся один раз при старте процесса
+
+def init_render_process(state):
+    RENDER_STATE.update(state)
+
+def render_in_process(job):
+    """render_page в процессе пула; время фаз возвращается вместе с результатом — METRICS у процесса свой."""
+    METRICS.phases = {}
+    result = render_page(job, RENDER_STATE)
+    result["phases"] = METRICS.phases
+    return result
+
+def render_pool(processes, state):
+    """Пул процессов отрисовки.
+
+    Процессы запускаются через spawn, а не fork: пул создаёт их при первом
+    submit, когда уже работают потоки выгрузки, и fork унаследовал бы
+    захваченные ими блокировки (METRICS.lock, LIMITER.cond, urllib3/ssl) —
+    процесс повис бы на первой же фазе.
+    """
+    if processes < 1:
+        return None
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=init_render_process, initargs=(state,))
+
+# ---------- ИНКРЕМЕНТАЛЬНАЯ ВЫГРУЗКА ----------
+
+MANIFEST_PATH = os.path.join("export", "manifest.json")
+
+class Manifest:
+    """export/manifest.json: что и в какой версии было выгружено прошлым запуском.
+
+    pages: {id: {"version", "title", "path", "hash", "attachments", "links"}}.
+    previous — состояние на начало запуска, pages — то, что получится в итоге.
+    """
+
+    def __init__(self, previous=None):
+        self.previous = previous or {}
+        self.pages = dict(self.previous)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        if not os.path.exists(MANIFEST_PATH):
+            return cls()
+        with open(MANIFEST_PATH, encoding="utf-8") as f:
+            return cls(json.load(f)["pages"])
+
+    def save(self):
+        tmp = MANIFEST_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"pages": self.pages}, f, ensure_ascii=False)
+        os.replace(tmp, MANIFEST_PATH)
+
+    def previous_attachments(self, page_id):
+        return self.previous.get(page_id, {}).get("attachments", {})
+
+    def record(self, page, path, digest, attachments, links):
+        with self.lock:
+            self.pages[page.id] = {
+                "version": page.version,
+                "title": page.title,
+                "path": path,
+                "hash": digest,
+                "attachments": attachments,
+                "links": sorted(links),
+            }
+
+def same_as_previous(entry, path, digest):
+    """Страница по пути path с хэшем digest уже лежит на диске с прошлого запуска (entry — запись манифеста)."""
+    return bool(entry) and entry["path"] == path and entry["hash"] == digest and os.path.exists(path)
+
+def foreign_attachments(page, entry):
+    """Вложения страницы в манифесте лежат не в её attachments/<id> (выгрузка прошлой версии скрипта)."""
+    own = os.path.join(os.path.dirname(page.path), attachments_dir(page))
+    return any(os.path.dirname(a["file"]) != own for a in entry["attachments"].values())
+
+def select_changed_pages(pages, pageid_to_path, manifest, refresh_menus):
+    """Страницы, которые нужно перерисовать.
+
+    Это новые, обновлённые и перенесённые страницы, а также те, что ссылаются
+    на появившиеся/исчезнувшие/перенесённые. Если меню встроено в страницы,
+    любое изменение дерева, в том числе переименование страницы, затрагивает
+    все страницы.
+    """
+    old = manifest.previous
+    changed = set()
     for p in pages:
-        ancestors = [a["id"] for a in p.get("ancestors", [])]
-        node = tree
-        for aid in ancestors:
-            node = node.setdefault(aid, {})
-        node[p["id"]] = {}
-
-    def build_tree(node):
-        html = ""
-        for pid, children in node.items():
-            title = next(p["title"] for p in pages if p["id"] == pid)
-            link = os.path.relpath(pageid_to_path[pid], "export")
-            if children:
-                html += f"<details><summary><a href='{link}'>{title}</a></summary>{build_tree(children)}</details>"
-            else:
-                html += f"<li><a href='{link}'>{title}</a></li>"
-        return html
+        entry = old.get(p.id)
+        if (entry is None or entry["version"] != p.version
+                or entry["path"] != pageid_to_path[p.id] or not os.path.exists(entry["path"])
+                or foreign_attachments(p, entry)):
+            changed.add(p.id)
+
+    moved = {pid for pid in changed if pid not in old or old[pid]["path"] != pageid_to_path[pid]}
+    moved |= set(old) - set(pageid_to_path)
+    # с --flat-paths и в _by_id/ путь от заголовка не зависит: переименование видно только по title
+    renamed = any(p.id in old and old[p.id].get("title") != p.title for p in pages)
+    if (moved or renamed) and refresh_menus:
+        return list(pages)
+
+    for p in pages:
+        if moved.intersection(old.get(p.id, {}).get("links", ())):
+            changed.add(p.id)
+    return [p for p in pages if p.id in changed]
+
+def remove_stale_files(manifest, pageid_to_path):
+    """Удаляет файлы удалённых/перенесённых страниц и вложения, на которые больше никто не ссылается."""
+    for pid in list(manifest.pages):
+        if pid not in pageid_to_path:
+            del manifest.pages[pid]
+
+    live_pages = set(pageid_to_path.values())
+    live_files = {a["file"] for e in manifest.pages.values() for a in e["attachments"].values()}
+    stale = [e["path"] for e in manifest.previous.values() if e["path"] not in live_pages]
+    stale += [a["file"] for e in manifest.previous.values() for a in e["attachments"].values()
+              if a["file"] not in live_files]
+    for path in stale:
+        if os.path.exists(path):
+            os.remove(path)
+            print(f"Удалил: {path}")
+            # чистим опустевшие каталоги вверх до export/
+            d = os.path.dirname(path)
+            while d != "export" and os.path.isdir(d) and not os.listdir(d):
+                os.rmdir(d)
+                d = os.path.dirname(d)
 
+# ---------- ЖУРНАЛ ДЛЯ --resume ----------
+
+CHECKPOINT_PATH = os.path.join("export", ".checkpoint.jsonl")
+
+class Checkpoint:
+    """Журнал прогресса: пройденные окна листинга и сохранённые страницы.
+
+    Каждая запись — строка JSON, сбрасываемая на диск сразу, поэтому журнал
+    переживает падение процесса. Вложения отдельно не журналируются: они
+    пишутся через .part и переименование, так что готовый файл и есть отметка.
+    """
+
+    def __init__(self, resume=False):
+        self.listing = {}  # {start: ответ лёгкого листинга /rest/api/content}
+        self.pages = {}  # {id: запись манифеста}
+        if resume and os.path.exists(CHECKPOINT_PATH):
+            with open(CHECKPOINT_PATH, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # строка, недописанная в момент падения
+                    if "listing" in entry:
+                        self.listing[entry["listing"]] = entry["data"]
+                    else:
+                        self.pages[entry["page"]] = entry["entry"]
+            print(f"Продолжаем: окон листинга {len(self.listing)}, страниц {len(self.pages)}")
+        os.makedirs("export", exist_ok=True)
+        self.f = open(CHECKPOINT_PATH, "a" if resume else "w", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def _write(self, entry):
+        with self.lock:
+            self.f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def listing_done(self, start, data):
+        self.listing[start] = data
+        self._write({"listing": start, "data": data})
+
+    def page_done(self, page_id, entry):
+        self.pages[page_id] = entry
+        self._write({"page": page_id, "entry": entry})
+
+    def finish(self):
+        """Закрывает журнал; удаляет его, если прогон завершился без ошибок."""
+        self.f.close()
+        os.remove(CHECKPOINT_PATH)
+
+def generate_index(menu, search=False, archive=None):
     html = """
     <html>
       <head>
         <meta charset="utf-8">
         <style>
-          body { font-family: sans-serif; }
-          details { margin-left: 15px; }
-          a { text-decoration: none; color: #0645AD; }
+          body {{ font-family: sans-serif; }}
+          details {{ margin-left: 15px; }}
+          a {{ text-decoration: none; color: #0645AD; }}
         </style>
       </head>
       <body>
         <h1>Confluence Export Index</h1>
         {}
+        {}
       </body>
     </html>
-    """.format(build_tree(tree))
+    """.format('<p><a href="search.html">Поиск</a></p>' if search else "", menu.render())
 
+    if archive is not None:
+        archive.write_text("index.html", html)
+        return
     with open("export/index.html", "w", encoding="utf-8") as f:
         f.write(html)
 
-def main():
+def save_pages(session, pages, state, workers, manifest, checkpoint, store, transfers, search, archive,
+               thumbs=None, renderers=None, render_queue=0):
+    """Сохраняет страницы из итератора последовательно или пулом потоков.
+
+    В пул одновременно отдаётся не больше 2 * workers страниц, чтобы тела
+    не копились в памяти быстрее, чем пишутся. Ошибка одной страницы не
+    прерывает прогон: страница (без тела) попадает в возвращаемый список упавших.
+    С renderers (ProcessPoolExecutor) страницы отрисовываются в отдельных
+    процессах, в очереди на отрисовку не больше render_queue страниц — см. save_pages_pipelined.
+    """
+    if renderers is not None:
+        return save_pages_pipelined(session, pages, state, workers, manifest, checkpoint, store, transfers,
+                                    search, archive, thumbs, renderers, render_queue)
+    failed = []
+
+    def job(page):
+        s = worker_session() if workers > 1 else session
+        return save_page_html(s, page, state, manifest, store, transfers, search, archive, thumbs)
+
+    def done(page, result):
+        try:
+            file_path = result()
+        except (requests.RequestException, OSError) as e:
+            page_failed(page, e, failed)
+            return
+        page_saved(page, file_path, manifest, checkpoint)
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            for page in pages:
+                if len(pending) >= 2 * workers:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in finished:
+                        done(pending.pop(fut), fut.result)
+                pending[pool.submit(job, page)] = page
+            for fut in as_completed(pending):
+                done(pending[fut], fut.result)
+    else:
+        for page in pages:
+            done(page, lambda: job(page))
+    return failed
+
+def page_failed(page, error, failed):
+    print(f"⚠️ Не удалось сохранить {page.title} ({page.id}): {error}")
+    page.body = None  # при повторе тело запросится заново
+    failed.append(page)
+
+def page_saved(page, file_path, manifest, checkpoint):
+    if file_path is None:
+        print(f"Пропустил удалённую страницу: {page.title}")
+        return
+    if checkpoint is not None:
+        checkpoint.page_done(page.id, manifest.pages[page.id])
+    print(f"Сохранил: {file_path}")
+
+def save_pages_pipelined(session, pages, state, workers, manifest, checkpoint, store, transfers, search,
+                         archive, thumbs, renderers, render_queue):
+    """Два этапа: потоки качают вложения и тела (fetch_page), процессы рисуют страницы (render_page).
+
+    Очередь на отрисовку ограничена render_queue страницами: пока она полна,
+    новые страницы не скачиваются, так что тела не копятся в памяти, если
+    сеть быстрее процессора. Учёт результатов (finish_page) идёт в этом потоке.
+    """
+    failed = []
+    fetching = {}  # future -> страница
+    rendering = {}  # future -> (страница, задание)
+    pages = iter(pages)
+    exhausted = False
+
+    def fetch(page):
+        return fetch_page(worker_session() if workers > 1 else session, page, manifest, store, transfers,
+                          search, archive, thumbs)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while True:
+            while not exhausted and len(fetching) < 2 * workers and len(rendering) < render_queue:
+                page = next(pages, None)
+                if page is None:
+                    exhausted = True
+                    break
+                fetching[pool.submit(fetch, page)] = page
+            if not fetching and not rendering:
+                break
+            finished, _ = wait(list(fetching) + list(rendering), return_when=FIRST_COMPLETED)
+            for fut in finished:
+                if fut in fetching:
+                    page = fetching.pop(fut)
+                    try:
+                        job = fut.result()
+                    except (requests.RequestException, OSError) as e:
+                        page_failed(page, e, failed)
+                        continue
+                    if job is None:
+                        page_saved(page, None, manifest, checkpoint)
+                        continue
+                    rendering[renderers.submit(render_in_process, job)] = (page, job)
+                    continue
+                page, job = rendering.pop(fut)
+                try:
+                    result = fut.result()
+                    METRICS.merge_phases(result.pop("phases"))
+                    file_path = finish_page(page, job, result, manifest, search, archive)
+                except OSError as e:
+                    page_failed(page, e, failed)
+                    continue
+                page_saved(page, file_path, manifest, checkpoint)
+    return failed
+
+def retry_failed(failed, session, *options):
+    """Очередь повторов: упавшие страницы перезапускаются с экспоненциальной паузой."""
+    for attempt in range(RETRY_ROUNDS):
+        if not failed:
+            break
+        pause = RETRY_BASE_DELAY * 2 ** attempt
+        print(f"Повтор {len(failed)} страниц через {pause} с (попытка {attempt + 1} из {RETRY_ROUNDS})")
+        time.sleep(pause)
+        failed = save_pages(session, failed, *options)
+    return failed
+
+def print_throughput(elapsed):
+    mb = STATS["bytes"] / (1024 * 1024)
+    elapsed = max(elapsed, 1e-9)
+    print(f"Страниц: {STATS['pages']} за {elapsed:.1f} с ({STATS['pages'] / elapsed:.2f} стр/с), "
+          f"вложений: {STATS['attachments']} ({mb:.1f} МБ, {mb / elapsed:.2f} МБ/с)")
+
+def export_space(args, pages=None, other_spaces=None):
+    """Выгружает пространство SPACE_KEY в export/ текущего каталога; возвращает список упавших страниц.
+
+    pages — уже полученный лёгкий листинг (пакетный режим), иначе запрашивается.
+    other_spaces — {"paths": {id: путь}, "titles": {(ключ, заголовок): id}} страниц
+    других пространств пакета: ссылки на них ведут в их локальные копии.
+    """
+    global BODY_FORMAT
+    started = time.monotonic()
     session = get_session()
-    pages = get_all_pages(session)
+    # архив пишется с нуля и --resume с ним несовместим — журнал ему не нужен
+    checkpoint = Checkpoint(resume=args.resume) if not args.archive else None
+    BODY_FORMAT = "storage" if args.local_render else "view"
+    if pages is None:
+        with METRICS.phase("listing"):
+            pages = get_all_pages(session, checkpoint, args.listing_limit, args.listing_workers)
 
     print(f"Всего страниц (ограничено): {len(pages)}")
 
+    allocator = path_allocator(args)
+    tree = page_tree(pages, allocator)
+    allocator.save()  # сразу: --resume после падения должен писать туда же
     pageid_to_path = {}
     for page in pages:
-        file_path = get_page_path(page) + ".html"
-        pageid_to_path[page["id"]] = file_path
+        pageid_to_path[page.id] = page.path + ".html"
 
-    for page in pages:
-        file_path = save_page_html(session, page, pageid_to_path, pages)
-        print(f"Сохранил: {file_path}")
+    menu = NavMenu(tree, pageid_to_path)
+    external_menu = args.menu == "external"
+    archive = open_archive(args.archive) if args.archive else None
+    # архив пишется с нуля: манифест прошлой выгрузки в export/ к нему не относится
+    manifest = Manifest() if archive is not None else Manifest.load()
+
+    todo = pages
+    if args.incremental:
+        todo = select_changed_pages(pages, pageid_to_path, manifest, refresh_menus=not external_menu)
+        print(f"Изменилось страниц: {len(todo)}")
+
+    if checkpoint is not None and checkpoint.pages:
+        manifest.pages.update(checkpoint.pages)
+        todo = [p for p in todo if p.id not in checkpoint.pages]
+
+    store = BlobStore(os.path.join("export", "_blobs")) if args.dedupe_attachments else None
+    transfers = TransferPool(get_session, args.download_workers) if args.download_workers > 1 else None
+    title_to_id = {(SPACE_KEY, p.title): p.id for p in pages}
+    link_paths = pageid_to_path
+    if other_spaces:
+        link_paths = {**other_spaces["paths"], **pageid_to_path}
+        title_to_id = {**other_spaces["titles"], **title_to_id}
+    search = SearchIndex(os.path.join("export", "_search"), resume=args.resume) if args.search_index else None
+    thumbs = None
+    if args.thumbnails and not thumbnails_available():
+        print("⚠️ --thumbnails: Pillow не установлен (pip install pillow), картинки остаются как есть")
+    elif args.thumbnails:
+        thumbs = Thumbnailer(os.path.join("export", "_previews"), args.thumbnail_size, args.thumbnail_processes)
+    state = {"link_paths": link_paths, "menu": menu, "title_to_id": title_to_id, "external_menu": external_menu}
+    renderers = render_pool(args.render_processes, state)
+    options = (state, args.workers, manifest, checkpoint, store, transfers, search, archive, thumbs,
+               renderers, 2 * args.render_processes)
+    failed = save_pages(session, iter_pages_with_bodies(session, todo, len(pages), args.listing_workers), *options)
+    failed = retry_failed(failed, session, *options)
 
-    generate_index(pages, pageid_to_path)
+    if transfers is not None:
+        transfers.shutdown()
+    if renderers is not None:
+        renderers.shutdown()
+    if thumbs is not None:
+        thumbs.close()
+
+    if archive is None:
+        remove_stale_files(manifest, pageid_to_path)
+        manifest.save()
+    if store is not None:
+        store.save()
+    if search is not None:
+        with METRICS.phase("search_index"):
+            search.finish(set(pageid_to_path))
+
+    with METRICS.phase("index"):
+        generate_index(menu, search is not None, archive)
     print("Индекс сгенерирован: export/index.html")
+    if external_menu:
+        with METRICS.phase("menu_asset"):
+            write_menu_asset(menu, archive)
+        print("Меню сохранено: export/menu.js")
+    if archive is not None:
+        archive.close()
+    print_throughput(time.monotonic() - started)
+    allocator.report()
+    if args.local_render:
+        print_render_summary()
+    if store is not None:
+        store.report()
+
+    if failed:
+        print(f"Не удалось сохранить страниц: {len(failed)}." + ("" if archive else " Продолжить: --resume"))
+        for page in failed:
+            print(f"  {page.id}: {page.title}")
+    elif checkpoint is not None:
+        checkpoint.finish()
+    return failed
+
+def main():
+    args = parse_args()
+    limiter = configure_limiter(args)
+    configure_cache(args)
+    failed = export_space(args)
+    close_cache()
+    report(args, exporter="new_way_saver_5", space=SPACE_KEY)
+    limiter.print_summary()
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,87 @@
+"""Компактные записи страниц вместо сырых ответов REST API.
+
+Ответ листинга тащит за каждой страницей _links, _expandable и полные
+объекты предков — на 100 тысяч страниц это сотни мегабайт словарей, хотя
+выгрузке нужны только id, заголовок, родитель, версия и путь. PageRecord
+хранит ровно это в __slots__, id интернированы (предки ссылаются на те же
+строки, что и сами страницы), а заголовки предков, не попавших в выгрузку,
+лежат один раз в PageTable.titles. Тело страницы живёт в записи только от
+окна листинга до записи страницы на диск.
+"""
+import sys
+
+
+class PageRecord:
+    """Метаданные одной страницы; body — тело (строка) до тех пор, пока страницу не записали."""
+
+    __slots__ = ("id", "title", "parent", "ancestors", "version", "path", "body")
+
+    def __init__(self, page_id, title, ancestors=(), version=None, path=None, body=None):
+        self.id = page_id
+        self.title = title
+        self.ancestors = ancestors  # кортеж id предков от корня
+        self.parent = ancestors[-1] if ancestors else None
+        self.version = version
+        self.path = path
+        self.body = body
+
+    def __repr__(self):
+        return f"PageRecord({self.id!r}, {self.title!r})"
+
+
+class PageTable:
+    """Страницы выгрузки в порядке листинга и интернированный индекс id -> номер записи.
+
+    Пути записям проставляет тот, кто строит по ним дерево (page_tree.PageTree).
+    """
+
+    def __init__(self):
+        self.records = []
+        self.index = {}  # {id: номер в records}
+        self.titles = {}  # {id: заголовок} предков, которых нет среди records
+
+    def add(self, page):
+        """Добавляет страницу из ответа REST API и возвращает её запись (повторный id — старую запись)."""
+        page_id = sys.intern(page["id"])
+        if page_id in self.index:
+            return self.records[self.index[page_id]]
+        ancestors = []
+        for a in page.get("ancestors", ()):
+            ancestor_id = sys.intern(a["id"])
+            if ancestor_id not in self.index:
+                self.titles.setdefault(ancestor_id, a["title"])
+            ancestors.append(ancestor_id)
+        record = PageRecord(page_id, page["title"], tuple(ancestors), page.get("version", {}).get("number"))
+        self.titles.pop(page_id, None)  # страница сама попала в выгрузку — заголовок в её записи
+        self.index[page_id] = len(self.records)
+        self.records.append(record)
+        return record
+
+    def extend(self, pages):
+        for page in pages:
+            self.add(page)
+
+    def get(self, page_id):
+        i = self.index.get(page_id)
+        return self.records[i] if i is not None else None
+
+    def title(self, page_id):
+        """Заголовок страницы или её предка, не попавшего в выгрузку."""
+        record = self.get(page_id)
+        return record.title if record is not None else self.titles.get(page_id)
+
+    def truncate(self, n):
+        """Оставляет первые n страниц (MAX_PAGES); заголовки отрезанных предков сохраняются."""
+        for record in self.records[n:]:
+            del self.index[record.id]
+            self.titles[record.id] = record.title
+        del self.records[n:]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
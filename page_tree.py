@@ -0,0 +1,104 @@
+"""Дерево страниц на массивах и относительные ссылки без os.path.relpath.
+
+Узел — номер i: parent[i], children[i], depth[i], title[i] и segment[i] —
+имя каталога/файла страницы. Путь узла (кортеж сегментов от корня)
+собирается один раз из пути родителя, а не из заголовков всех предков на
+каждой странице. relative_link считает относительную ссылку по сегментам,
+без обращений к файловой системе, и кэширует разбор каталогов-источников —
+у соседних страниц каталог один и тот же.
+"""
+import os
+from functools import lru_cache
+
+
+class PageTree:
+    """Лес страниц: списки-столбцы по номеру узла и индекс id -> номер."""
+
+    def __init__(self):
+        self.ids = []
+        self.index = {}  # {id: номер узла}
+        self.parent = []  # номер родителя или -1
+        self.children = []  # [номера детей] в порядке добавления
+        self.depth = []
+        self.title = []
+        self.segment = []
+        self.paths = []  # кортеж сегментов от корня, считается по требованию
+        self.roots = []
+
+    def add(self, page_id, title, parent=-1, segment=None, path=None):
+        """Добавляет узел (или возвращает уже добавленный) под узлом parent; возвращает его номер.
+
+        path — готовый путь узла, если он не продолжает путь родителя
+        (страницу перенесли из-за длины пути, см. path_allocator).
+        """
+        i = self.index.get(page_id)
+        if i is not None:
+            return i
+        i = len(self.ids)
+        self.index[page_id] = i
+        self.ids.append(page_id)
+        self.parent.append(parent)
+        self.children.append([])
+        self.depth.append(self.depth[parent] + 1 if parent >= 0 else 0)
+        self.title.append(title)
+        self.segment.append(title if segment is None else segment)
+        self.paths.append(path)
+        if parent >= 0:
+            self.children[parent].append(i)
+        else:
+            self.roots.append(i)
+        return i
+
+    @classmethod
+    def from_pages(cls, pages, segment_of=None):
+        """Дерево по PageTable: страницы и их предки, в том числе не попавшие в выгрузку.
+
+        segment_of(заголовок) — имя сегмента пути по заголовку (по умолчанию сам заголовок).
+        """
+        tree = cls()
+        for page in pages:
+            parent = -1
+            for ancestor_id in page.ancestors:
+                title = pages.title(ancestor_id)
+                parent = tree.add(ancestor_id, title, parent, segment_of(title) if segment_of else None)
+            tree.add(page.id, page.title, parent, segment_of(page.title) if segment_of else None)
+        return tree
+
+    def path(self, i):
+        """Сегменты пути узла i от корня."""
+        path = self.paths[i]
+        if path is None:
+            parent = self.parent[i]
+            path = (self.path(parent) if parent >= 0 else ()) + (self.segment[i],)
+            self.paths[i] = path
+        return path
+
+
+@lru_cache(maxsize=4096)
+def split_dir(path):
+    """Сегменты нормализованного относительного пути ("" и "." — пустой кортеж)."""
+    if path in ("", os.curdir):
+        return ()
+    return tuple(path.split(os.sep))
+
+
+def common_prefix(a, b):
+    """Сколько первых сегментов у путей-кортежей a и b совпадает."""
+    common = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        common += 1
+    return common
+
+
+def relative_parts(target, start):
+    """os.path.relpath для путей-кортежей сегментов (target — файл или каталог, start — каталог)."""
+    common = common_prefix(target, start)
+    return os.sep.join((os.pardir,) * (len(start) - common) + target[common:]) or os.curdir
+
+
+@lru_cache(maxsize=65536)
+def relative_link(path, start):
+    """os.path.relpath(path, start) для нормализованных относительных путей — без обращений к os."""
+    return relative_parts(split_dir(path), split_dir(start))
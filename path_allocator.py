@@ -0,0 +1,163 @@
+"""Пути страниц: одна карта id -> путь на всю выгрузку, без коллизий и слишком длинных имён.
+
+Раньше путь собирался из заголовков прямо при записи: две страницы с
+одинаковым заголовком у одного родителя молча писались в один файл, а
+длинные цепочки кириллических заголовков упирались в пределы файловой
+системы (255 байт на имя, PATH_MAX на путь) — страница падала или при
+каждом запуске переписывалась заново. PathAllocator раздаёт пути до начала
+выгрузки, родитель за родителем:
+
+- заголовок чистится от символов, недопустимых в именах файлов (в том числе
+  в Windows — архив могут распаковать и там), приводится к NFC и режется по
+  байтам UTF-8, а не по символам;
+- из одноимённых соседей (без учёта регистра) имя без суффикса получает тот,
+  у кого оно было в прошлый раз, иначе страница с меньшим id; остальным
+  дописывается _<id> — суффикс не зависит от порядка обхода;
+- страница, путь которой длиннее max_path_bytes, переезжает в _by_id/<id>;
+- имена, которые выгрузка пишет в свой корень сама (index.html, _blobs и
+  т.п., параметр reserved), корневым страницам не достаются;
+- flat=True — все страницы просто <id>.
+
+Карта сохраняется в JSON, поэтому инкрементальные и параллельные выгрузки
+пишут каждую страницу туда же, куда и прошлый запуск.
+"""
+import json
+import os
+import re
+import unicodedata
+
+LONG_DIR = "_by_id"  # сюда переезжают страницы со слишком длинным путём
+UNSAFE_RE = re.compile(r'[\x00-\x1f\x7f/\\<>:"|?*]')
+RESERVED = {"CON", "PRN", "AUX", "NUL", *(f"COM{i}" for i in range(1, 10)), *(f"LPT{i}" for i in range(1, 10))}
+
+
+def truncate_bytes(text, limit):
+    """Начало text не длиннее limit байт UTF-8 (без разрезанных символов)."""
+    data = text.encode("utf-8")
+    if len(data) <= limit:
+        return text
+    return data[:limit].decode("utf-8", "ignore")
+
+
+def clean_segment(title, max_bytes, taken=()):
+    """Имя файла/каталога по заголовку: без запрещённых символов, не длиннее max_bytes байт.
+
+    taken — занятые выгрузкой имена (в нижнем регистре, casefold): такое имя получает "_" в начале.
+    """
+    name = UNSAFE_RE.sub("_", unicodedata.normalize("NFC", title))
+    name = truncate_bytes(name, max_bytes).strip().rstrip(".")
+    folded = name.casefold()
+    if not name or name.split(".")[0].upper() in RESERVED or folded == LONG_DIR or folded in taken:
+        name = "_" + name
+    return name
+
+
+def add_path_args(parser):
+    parser.add_argument("--flat-paths", action="store_true",
+                        help="Класть страницы по id (<id>), а не в каталоги по заголовкам предков")
+    parser.add_argument("--max-name-bytes", type=int, default=180,
+                        help="Предел длины имени файла/каталога страницы, байт UTF-8")
+    parser.add_argument("--max-path-bytes", type=int, default=1000,
+                        help="Предел длины пути страницы внутри выгрузки, байт UTF-8 "
+                             "(длиннее — страница переезжает в " + LONG_DIR + "/<id>)")
+
+
+def path_bytes(parts):
+    return len("/".join(parts).encode("utf-8"))
+
+
+class PathAllocator:
+    """Карта id -> путь (кортеж сегментов) для всех страниц выгрузки.
+
+    max_name_bytes — предел одного сегмента, max_path_bytes — всего пути
+    внутри каталога выгрузки; reserve — сколько байт дописывает к пути
+    выгрузка (".html", "/index.html" и т.п.). map_path — JSON с картой
+    прошлого запуска (None — не сохранять). reserved — имена сегментов,
+    занятые в корне выгрузки её собственными файлами и каталогами (для
+    страницы-файла <сегмент>.html — сам сегмент, например "index").
+    """
+
+    def __init__(self, map_path=None, max_name_bytes=180, max_path_bytes=1000, flat=False, reserve=0,
+                 reserved=()):
+        self.map_path = map_path
+        self.max_name_bytes = max_name_bytes
+        self.max_path_bytes = max_path_bytes
+        self.flat = flat
+        self.reserve = reserve
+        self.reserved = {name.casefold() for name in reserved}
+        self.previous = {}
+        if map_path and os.path.exists(map_path):
+            with open(map_path, encoding="utf-8") as f:
+                self.previous = {pid: tuple(path.split("/")) for pid, path in json.load(f)["paths"].items()}
+        self.paths = {}
+        self.relocated = 0
+        self.suffixed = 0
+
+    def place(self, parent_id, pages):
+        """Раздаёт пути детям parent_id (None — корням): pages — [(id, заголовок)] всех детей сразу.
+
+        Возвращает список путей в том же порядке.
+        """
+        base = self.paths[parent_id] if parent_id is not None else ()
+        if self.flat:
+            for page_id, _ in pages:
+                self.paths[page_id] = (page_id,)
+            return [self.paths[page_id] for page_id, _ in pages]
+
+        limit = self.max_name_bytes
+        taken = self.reserved if not base else ()
+        names = {page_id: clean_segment(title, limit, taken) for page_id, title in pages}
+        groups = {}
+        for page_id, _ in pages:
+            groups.setdefault(names[page_id].casefold(), []).append(page_id)
+
+        taken = set()
+        losers = []
+        for key, ids in groups.items():
+            owner = min(ids, key=lambda pid: (self.previous.get(pid) != base + (names[pid],), len(pid), pid))
+            taken.add(key)
+            self.paths[owner] = base + (names[owner],)
+            losers.extend(pid for pid in ids if pid != owner)
+        for page_id in sorted(losers, key=lambda pid: (len(pid), pid)):
+            name = names[page_id]
+            suffix = f"_{page_id}"
+            while True:
+                name = truncate_bytes(name, limit - len(suffix.encode("utf-8"))).rstrip(". ") + suffix
+                if name.casefold() not in taken:
+                    break
+            taken.add(name.casefold())
+            self.paths[page_id] = base + (name,)
+            self.suffixed += 1
+
+        for page_id, _ in pages:
+            if path_bytes(self.paths[page_id]) + self.reserve > self.max_path_bytes:
+                self.paths[page_id] = (LONG_DIR, page_id)
+                self.relocated += 1
+        return [self.paths[page_id] for page_id, _ in pages]
+
+    def place_tree(self, tree):
+        """Пути всем узлам PageTree, родитель раньше детей; возвращает self.paths."""
+        level = [(None, tree.roots)]
+        while level:
+            next_level = []
+            for parent_id, indexes in level:
+                self.place(parent_id, [(tree.ids[i], tree.title[i]) for i in indexes])
+                next_level.extend((tree.ids[i], tree.children[i]) for i in indexes if tree.children[i])
+            level = next_level
+        return self.paths
+
+    def save(self):
+        """Сохраняет карту этого запуска: ушедшие страницы из неё выпадают."""
+        if not self.map_path:
+            return
+        paths = {pid: "/".join(path) for pid, path in self.paths.items()}
+        os.makedirs(os.path.dirname(self.map_path) or ".", exist_ok=True)
+        tmp = self.map_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"paths": paths}, f, ensure_ascii=False)
+        os.replace(tmp, self.map_path)
+
+    def report(self):
+        if self.suffixed or self.relocated:
+            print(f"Пути: одноимённых страниц с суффиксом _id: {self.suffixed}, "
+                  f"слишком длинных путей (перенесены в {LONG_DIR}/): {self.relocated}")
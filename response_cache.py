@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import threading
+
+import confluence_http
+from confluence_http import retry_get
+
+MB = 1024 * 1024
+DEFAULT_CACHE_DIR = ".http_cache"
+SAVE_EVERY = 200  # index.json переписывается раз в столько новых записей, чтобы падение не обнулило кэш
+
+
+class ResponseCache:
+    """Кэш JSON-ответов REST API на диске: <root>/<ключ>.json и index.json.
+
+    Ключ — URL (с параметрами) и версия содержимого, если её знает вызывающий:
+    ответ для той же версии страницы отдаётся без запроса. Без версии ответ
+    перепроверяется условным запросом (If-None-Match / If-Modified-Since) —
+    304 без тела вместо всего списка; если сервер не дал ни ETag, ни
+    Last-Modified, запрос идёт как обычно. Размер ограничен max_bytes,
+    лишнее вытесняется начиная с давно не использованного. offline — всё из
+    кэша без перепроверки; промах кончается ошибкой retry_get (сеть выключена).
+    """
+
+    def __init__(self, root, max_bytes=512 * MB, offline=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.index_path = os.path.join(root, "index.json")
+        os.makedirs(root, exist_ok=True)
+        self.index = {}  # {ключ: {"url", "version", "etag", "last_modified", "size", "used"}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                self.index = json.load(f)
+        self.lock = threading.Lock()
+        self.clock = max((e["used"] for e in self.index.values()), default=0)
+        self.size = sum(e["size"] for e in self.index.values())
+        self.unsaved = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key[:2], key + ".json")
+
+    def get_json(self, session, url, version=None, params=None):
+        """JSON ответа на GET url (None при 404), по возможности из кэша."""
+        key = cache_key(url, version, params)
+        with self.lock:
+            entry = self.index.get(key)
+        if entry is not None and (version is not None or self.offline):
+            data = self.read(key)
+            if data is not None:
+                with self.lock:
+                    self.hits += 1
+                return data
+
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        r = retry_get(session, url, params=params, headers=headers)
+        if r is not None and r.status_code == 304:
+            data = self.read(key)
+            if data is not None:
+                with self.lock:
+                    self.revalidated += 1
+                return data
+            r = retry_get(session, url, params=params)  # файл из кэша пропал — без условий
+        with self.lock:
+            self.misses += 1
+        if r is None:
+            return None  # 404 не кэшируем: страницу могут вернуть
+        self.put(key, url, version, r)
+        return r.json()
+
+    def read(self, key):
+        try:
+            with open(self.entry_path(key), "rb") as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            if key in self.index:
+                self.clock += 1
+                self.index[key]["used"] = self.clock
+        return data
+
+    def put(self, key, url, version, r):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(r.content)
+        os.replace(tmp, path)
+        with self.lock:
+            old = self.index.get(key)
+            if old is not None:
+                self.size -= old["size"]
+            self.clock += 1
+            self.index[key] = {
+                "url": url,
+                "version": version,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "size": len(r.content),
+                "used": self.clock,
+            }
+            self.size += len(r.content)
+            self.evict()
+            self.unsaved += 1
+            if self.unsaved >= SAVE_EVERY:
+                self.save_locked()
+
+    def evict(self):
+        """Вытесняет давно не использованные записи, пока кэш больше max_bytes (под self.lock)."""
+        if self.size <= self.max_bytes:
+            return
+        for key, entry in sorted(self.index.items(), key=lambda kv: kv[1]["used"]):
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(self.entry_path(key))
+            except OSError:
+                pass
+            del self.index[key]
+            self.size -= entry["size"]
+            self.evicted += 1
+
+    def save(self):
+        with self.lock:
+            self.save_locked()
+
+    def save_locked(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.index, f, ensure_ascii=False)
+        os.replace(tmp, self.index_path)
+        self.unsaved = 0
+
+    def report(self):
+        print(f"HTTP-кэш {self.root}: из кэша {self.hits}, подтверждено 304: {self.revalidated}, "
+              f"запрошено {self.misses}, вытеснено {self.evicted}; "
+              f"записей {len(self.index)}, {self.size / MB:.1f} МБ")
+
+
+def cache_key(url, version=None, params=None):
+    text = url + "\n" + json.dumps(params, sort_keys=True) + "\n" + str(version)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+CACHE = None
+
+
+def add_cache_args(parser):
+    parser.add_argument("--http-cache", metavar="DIR",
+                        help="Кэшировать ответы REST API (списки страниц, детей, вложений, тела) в каталоге DIR")
+    parser.add_argument("--http-cache-mb", type=int, default=512,
+                        help="Предельный размер HTTP-кэша, МБ (лишнее вытесняется по давности использования)")
+    parser.add_argument("--offline", action="store_true",
+                        help="Не ходить в сеть: ответы только из HTTP-кэша (по умолчанию " + DEFAULT_CACHE_DIR + ")")
+
+
+def configure_cache(args):
+    """Включает общий CACHE по аргументам командной строки (или выключает, если --http-cache не задан)."""
+    global CACHE
+    root = args.http_cache or (DEFAULT_CACHE_DIR if args.offline else None)
+    CACHE = ResponseCache(root, args.http_cache_mb * MB, args.offline) if root else None
+    confluence_http.OFFLINE = args.offline
+    return CACHE
+
+
+def get_json(session, url, version=None, params=None):
+    """retry_get(...).json() через CACHE, если он включён; None при 404."""
+    if CACHE is not None:
+        return CACHE.get_json(session, url, version, params)
+    r = retry_get(session, url, params=params)
+    return r.json() if r is not None else None
+
+
+def is_offline():
+    return CACHE is not None and CACHE.offline
+
+
+def close_cache():
+    if CACHE is not None:
+        CACHE.save()
+        CACHE.report()
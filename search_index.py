@@ -0,0 +1,273 @@
+import json
+import os
+import re
+import shutil
+import threading
+
+SHARDS = 64  # токен попадает в шард по хэшу; браузер грузит только шарды слов из запроса
+TOKEN_RE = re.compile(r"\w{2,30}")
+SHARD_PREFIX = "searchShard("  # шард — JS-файл с вызовом, чтобы работать и с file://
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def shard_of(token):
+    """FNV-1a по кодам символов; та же функция есть в search.js."""
+    h = 2166136261
+    for ch in token:
+        h = ((h ^ ord(ch)) * 16777619) & 0xFFFFFFFF
+    return h % SHARDS
+
+
+def write_atomic(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class SearchIndex:
+    """Полнотекстовый индекс выгрузки: токен -> {id страницы: [позиции]}, разбитый на шарды.
+
+    Во время выгрузки постинги каждой страницы дописываются в spool/NN.jsonl
+    своего шарда, так что в памяти не копится ничего, кроме списка страниц.
+    finish() сливает spool с прежним индексом по одному шарду за раз:
+    переиндексированные и удалённые страницы вычищаются, остальные остаются
+    как были — поэтому --incremental обновляет только затронутые шарды.
+    spool переживает падение, и с --resume уже проиндексированные страницы
+    не теряются.
+    """
+
+    def __init__(self, root, resume=False):
+        self.root = root
+        self.spool_dir = os.path.join(root, "spool")
+        if not resume:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.docs_path = os.path.join(root, "docs.json")
+        self.docs = {}  # {id: {"title", "path", "shards"}}
+        if os.path.exists(self.docs_path):
+            with open(self.docs_path, encoding="utf-8") as f:
+                self.docs = json.load(f)
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def spool(self, name):
+        if name not in self.files:
+            self.files[name] = open(os.path.join(self.spool_dir, name), "a", encoding="utf-8")
+        return self.files[name]
+
+    def add(self, page_id, title, path, text):
+        """Индексирует страницу; path — путь к .html относительно корня выгрузки."""
+        postings = {}
+        for pos, token in enumerate(tokenize(title + " " + text)):
+            postings.setdefault(shard_of(token), {}).setdefault(token, []).append(pos)
+        with self.lock:
+            for shard, tokens in postings.items():
+                self.spool(f"{shard:02d}.jsonl").write(json.dumps([page_id, tokens], ensure_ascii=False) + "\n")
+            doc = {"title": title, "path": path, "shards": sorted(postings)}
+            self.spool("docs.jsonl").write(json.dumps([page_id, doc], ensure_ascii=False) + "\n")
+            for f in self.files.values():
+                f.flush()
+
+    def finish(self, live_ids):
+        """Сливает spool с индексом; страницы не из live_ids из индекса убираются."""
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        fresh = dict(read_jsonl(os.path.join(self.spool_dir, "docs.jsonl")))
+        dropped = set(fresh) | {pid for pid in self.docs if pid not in live_ids}
+
+        dirty = {}  # {шард: id, чьи прежние постинги надо вычистить}
+        for pid in dropped:
+            for shard in self.docs.get(pid, {}).get("shards", []):
+                dirty.setdefault(shard, set()).add(pid)
+        for doc in fresh.values():
+            for shard in doc["shards"]:
+                dirty.setdefault(shard, set())
+
+        for shard, stale in dirty.items():
+            index = self.load_shard(shard)
+            if stale:
+                for token in list(index):
+                    for pid in stale & index[token].keys():
+                        del index[token][pid]
+                    if not index[token]:
+                        del index[token]
+            seen = set()
+            for pid, tokens in read_jsonl(os.path.join(self.spool_dir, f"{shard:02d}.jsonl")):
+                if pid in seen:
+                    # страницу проиндексировали дважды (повтор после сбоя) — верна последняя запись
+                    for entry in index.values():
+                        entry.pop(pid, None)
+                seen.add(pid)
+                for token, positions in tokens.items():
+                    index.setdefault(token, {})[pid] = positions
+            self.save_shard(shard, index)
+
+        for pid in dropped:
+            self.docs.pop(pid, None)
+        for pid, doc in fresh.items():
+            if pid in live_ids:
+                self.docs[pid] = doc
+        write_atomic(self.docs_path, json.dumps(self.docs, ensure_ascii=False))
+        client_docs = {pid: [d["title"], d["path"]] for pid, d in self.docs.items()}
+        write_atomic(os.path.join(self.root, "docs.js"),
+                     f"var SEARCH_SHARDS = {SHARDS};\nvar SEARCH_DOCS = "
+                     + json.dumps(client_docs, ensure_ascii=False, separators=(",", ":")) + ";\n")
+        write_atomic(os.path.join(self.root, "search.js"), SEARCH_JS)
+        write_atomic(os.path.join(os.path.dirname(self.root), "search.html"), SEARCH_HTML)
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        print(f"Поисковый индекс: страниц {len(self.docs)}, обновлено шардов {len(dirty)} из {SHARDS}")
+
+    def shard_path(self, shard):
+        return os.path.join(self.root, f"{shard:02d}.js")
+
+    def load_shard(self, shard):
+        path = self.shard_path(shard)
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        # searchShard(NN, {...});
+        return json.loads(text[text.index(",") + 1:text.rindex(")")])
+
+    def save_shard(self, shard, index):
+        if not index:
+            if os.path.exists(self.shard_path(shard)):
+                os.remove(self.shard_path(shard))
+            return
+        write_atomic(self.shard_path(shard), f"{SHARD_PREFIX}{shard},"
+                     + json.dumps(index, ensure_ascii=False, separators=(",", ":")) + ");\n")
+
+
+def read_jsonl(path):
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                break  # строка, недописанная в момент падения
+
+
+SEARCH_JS = r"""
+var searchCache = {};
+var searchWaiting = {};
+function searchShard(n, data) {
+  searchCache[n] = data;
+  (searchWaiting[n] || []).forEach(function (cb) { cb(); });
+  delete searchWaiting[n];
+}
+function shardOf(token) {
+  var h = 2166136261;
+  for (var ch of token) { h = Math.imul(h ^ ch.codePointAt(0), 16777619) >>> 0; }
+  return h % SEARCH_SHARDS;
+}
+function loadShard(n, cb) {
+  if (searchCache[n]) { return cb(); }
+  if (searchWaiting[n]) { return searchWaiting[n].push(cb); }
+  searchWaiting[n] = [cb];
+  var s = document.createElement("script");
+  s.src = "_search/" + (n < 10 ? "0" : "") + n + ".js";
+  s.onerror = function () { searchShard(n, {}); };  // шарда нет — в нём ни одного слова
+  document.head.appendChild(s);
+}
+function tokenize(text) {
+  return (text.toLowerCase().match(/[\p{L}\p{N}_]{2,30}/gu) || []);
+}
+// "фраза в кавычках" — слова подряд; остальные слова — все должны встретиться на странице
+function search(query, done) {
+  var phrases = [];
+  var words = [];
+  query.replace(/"([^"]*)"|(\S+)/g, function (_, phrase, word) {
+    var tokens = tokenize(phrase !== undefined ? phrase : word);
+    if (phrase !== undefined && tokens.length > 1) { phrases.push(tokens); } else { words.push.apply(words, tokens); }
+  });
+  var all = words.concat.apply(words, phrases);
+  if (!all.length) { return done([]); }
+  var left = all.length;
+  all.forEach(function (t) { loadShard(shardOf(t), function () { if (--left === 0) { done(rank(words, phrases)); } }); });
+}
+function postings(token) { return searchCache[shardOf(token)][token] || {}; }
+function rank(words, phrases) {
+  var scores = null;
+  function keep(hits) {
+    var next = {};
+    for (var id in hits) { if (scores === null || id in scores) { next[id] = (scores ? scores[id] : 0) + hits[id]; } }
+    scores = next;
+  }
+  words.forEach(function (t) {
+    var hits = {};
+    var p = postings(t);
+    for (var id in p) { hits[id] = p[id].length; }
+    keep(hits);
+  });
+  phrases.forEach(function (tokens) {
+    var hits = {};
+    var first = postings(tokens[0]);
+    for (var id in first) {
+      var n = first[id].filter(function (pos) {
+        return tokens.every(function (t, i) { var p = postings(t)[id]; return p && p.indexOf(pos + i) >= 0; });
+      }).length;
+      if (n) { hits[id] = 10 * n; }
+    }
+    keep(hits);
+  });
+  return Object.keys(scores || {}).sort(function (a, b) { return scores[b] - scores[a]; })
+    .map(function (id) { return {id: id, title: SEARCH_DOCS[id][0], path: SEARCH_DOCS[id][1]}; });
+}
+function runSearch() {
+  var q = document.getElementById("q").value;
+  location.hash = encodeURIComponent(q);
+  search(q, function (results) {
+    var out = document.getElementById("results");
+    out.innerHTML = "";
+    var info = document.createElement("p");
+    info.textContent = "Найдено: " + results.length;
+    out.appendChild(info);
+    results.slice(0, 200).forEach(function (r) {
+      var li = document.createElement("li");
+      var a = document.createElement("a");
+      a.href = encodeURI(r.path);
+      a.textContent = r.title;
+      li.appendChild(a);
+      out.appendChild(li);
+    });
+  });
+  return false;
+}
+window.addEventListener("load", function () {
+  if (location.hash.length > 1) {
+    document.getElementById("q").value = decodeURIComponent(location.hash.slice(1));
+    runSearch();
+  }
+});
+"""
+
+SEARCH_HTML = """<html>
+  <head>
+    <meta charset="utf-8">
+    <title>Поиск</title>
+    <style>
+      body { font-family: sans-serif; margin: 20px; }
+      input { width: 400px; font-size: 16px; }
+      a { text-decoration: none; color: #0645AD; }
+    </style>
+    <script src="_search/docs.js"></script>
+    <script src="_search/search.js"></script>
+  </head>
+  <body>
+    <h1>Поиск по выгрузке</h1>
+    <form onsubmit="return runSearch()">
+      <input id="q" autofocus placeholder='слова или "точная фраза"'>
+      <button>Найти</button>
+    </form>
+    <ul id="results"></ul>
+    <p><a href="index.html">← к оглавлению</a></p>
+  </body>
+</html>
+"""
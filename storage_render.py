@@ -0,0 +1,269 @@
+"""Отрисовка body.storage в HTML на своей стороне вместо body.view.
+
+body.view заставляет Confluence выполнить на сервере каждый макрос страницы —
+это самый тяжёлый для сервера запрос, от него и идут 429. body.storage
+сервер отдаёт как есть, а частые элементы хранимого формата несложно
+перевести в HTML самим: ac:link (страницы, вложения, внешние ссылки,
+якоря), ac:image, макросы code/noformat, info/tip/note/warning/panel,
+expand, toc, anchor, списки задач и разметку колонок (ac:layout).
+
+Ссылки получаются в том же виде, что и в body.view (/display/КЛЮЧ/Заголовок,
+/download/attachments/id/имя), поэтому дальше их переписывает тот же
+rewrite_links. Если на странице есть что-то ещё (упоминания, include,
+children, Jira и т.п.), render_storage возвращает None, и страницу нужно
+брать в body.view.
+"""
+import re
+from html import escape, unescape
+from html.parser import HTMLParser
+from urllib.parse import quote, quote_plus
+
+PANELS = {"info": "information", "tip": "tip", "note": "note", "warning": "warning", "panel": "panel"}
+CODE_MACROS = ("code", "noformat")
+EMOTICONS = {"smile": "🙂", "sad": "🙁", "cheeky": "😛", "laugh": "😀", "wink": "😉", "thumbs-up": "👍",
+             "thumbs-down": "👎", "information": "ℹ️", "tick": "✔️", "cross": "❌", "warning": "⚠️",
+             "plus": "➕", "minus": "➖", "question": "❓", "light-on": "💡", "light-off": "💡",
+             "yellow-star": "⭐", "red-star": "⭐", "green-star": "⭐", "blue-star": "⭐"}
+# обёртки, чьё содержимое просто идёт в вывод как есть
+TRANSPARENT = {"ac:layout": "<div class='layout'>", "ac:layout-section": "<div class='layout-section'>",
+               "ac:layout-cell": "<div class='layout-cell'>", "ac:inline-comment-marker": "<span>"}
+TOC_MARKER = "\x02toc\x02"
+HEADING_RE = re.compile(r"<h([1-6])((?:\s[^>]*)?)>(.*?)</h\1>", re.S | re.I)
+TAG_RE = re.compile(r"<[^>]+>")
+
+
+class Unsupported(Exception):
+    """На странице есть элемент хранимого формата, который здесь не отрисовать."""
+
+
+class StorageRenderer(HTMLParser):
+    """Один проход по body.storage: обычная разметка копируется, ac:/ri: переводятся в HTML.
+
+    Элементы ac: собираются во «фреймы» на стеке: ресурс ri:, параметры,
+    тела. Вывод пишется в верхний буфер self.buffers — тело макроса или
+    ссылки пишется в свой буфер и забирается фреймом при закрытии.
+    """
+
+    def __init__(self, page_id, space_key, base_path):
+        super().__init__(convert_charrefs=False)
+        self.page_id = page_id
+        self.space_key = space_key
+        self.base_path = base_path
+        self.buffers = [[]]
+        self.frames = []
+        self.toc = False
+
+    # ---------- вывод ----------
+
+    def emit(self, text):
+        self.buffers[-1].append(text)
+
+    def push(self):
+        self.buffers.append([])
+
+    def pop(self):
+        return "".join(self.buffers.pop())
+
+    # ---------- события парсера ----------
+
+    def handle_starttag(self, tag, attrs):
+        if tag.startswith(("ac:", "ri:")):
+            self.start_element(tag, dict(attrs))
+        else:
+            self.emit(self.get_starttag_text())
+
+    def handle_startendtag(self, tag, attrs):
+        if tag.startswith(("ac:", "ri:")):
+            self.start_element(tag, dict(attrs))
+            self.end_element(tag)
+        else:
+            self.emit(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if tag.startswith(("ac:", "ri:")):
+            self.end_element(tag)
+        else:
+            self.emit(f"</{tag}>")
+
+    def handle_data(self, data):
+        self.emit(data)
+
+    def handle_entityref(self, name):
+        self.emit(f"&{name};")
+
+    def handle_charref(self, name):
+        self.emit(f"&#{name};")
+
+    def handle_comment(self, data):
+        pass
+
+    def unknown_decl(self, data):
+        if data.startswith("CDATA["):
+            frame = self.frames[-1] if self.frames else None
+            if frame is not None and frame["tag"] in ("ac:plain-text-body", "ac:plain-text-link-body"):
+                self.emit(data[6:])  # сырой текст, экранируется при выводе
+            else:
+                self.emit(escape(data[6:]))
+
+    # ---------- элементы ac:/ri: ----------
+
+    def start_element(self, tag, attrs):
+        frame = {"tag": tag, "attrs": attrs}
+        if tag in ("ac:structured-macro", "ac:macro"):
+            name = attrs.get("ac:name", "")
+            if name not in PANELS and name not in CODE_MACROS and name not in ("expand", "toc", "anchor"):
+                raise Unsupported(f"макрос {name}")
+            frame.update(name=name, params={}, body="", plain="")
+        elif tag in ("ac:link", "ac:image"):
+            frame.update(resource=None, body=None)
+        elif tag.startswith("ri:"):
+            if tag not in ("ri:page", "ri:attachment", "ri:url"):
+                raise Unsupported(tag)
+            if self.frames and self.frames[-1]["tag"] == "ri:attachment":
+                raise Unsupported("вложение другой страницы")
+            if self.frames and "resource" in self.frames[-1]:
+                self.frames[-1]["resource"] = (tag, attrs)
+        elif tag in TRANSPARENT:
+            self.emit(TRANSPARENT[tag])
+        elif tag == "ac:emoticon":
+            self.emit(EMOTICONS.get(attrs.get("ac:name"), ""))
+        elif tag == "ac:task-list":
+            self.emit("<ul class='task-list'>")
+        elif tag == "ac:task":
+            frame.update(status="", body="")
+        elif tag not in ("ac:parameter", "ac:rich-text-body", "ac:plain-text-body", "ac:link-body",
+                         "ac:plain-text-link-body", "ac:task-id", "ac:task-status", "ac:task-body",
+                         "ac:placeholder"):
+            raise Unsupported(tag)
+        self.frames.append(frame)
+        if tag in ("ac:parameter", "ac:rich-text-body", "ac:plain-text-body", "ac:link-body",
+                   "ac:plain-text-link-body", "ac:task-id", "ac:task-status", "ac:task-body", "ac:placeholder"):
+            self.push()
+
+    def end_element(self, tag):
+        if not self.frames or self.frames[-1]["tag"] != tag:
+            raise Unsupported(f"непарный </{tag}>")
+        frame = self.frames.pop()
+        parent = self.frames[-1] if self.frames else {}
+        if tag == "ac:parameter":
+            text = self.pop()
+            if "params" in parent:
+                parent["params"][frame["attrs"].get("ac:name", "")] = unescape(TAG_RE.sub("", text))
+        elif tag in ("ac:rich-text-body", "ac:link-body", "ac:task-body"):
+            parent["body"] = self.pop()
+        elif tag in ("ac:plain-text-body", "ac:plain-text-link-body"):
+            parent["plain" if tag == "ac:plain-text-body" else "body"] = escape(self.pop(), quote=False)
+        elif tag == "ac:task-status":
+            parent["status"] = self.pop().strip()
+        elif tag in ("ac:task-id", "ac:placeholder"):
+            self.pop()
+        elif tag in ("ac:structured-macro", "ac:macro"):
+            self.emit(self.render_macro(frame))
+        elif tag == "ac:link":
+            self.emit(self.render_link(frame))
+        elif tag == "ac:image":
+            self.emit(self.render_image(frame))
+        elif tag in TRANSPARENT:
+            self.emit("</span>" if tag == "ac:inline-comment-marker" else "</div>")
+        elif tag == "ac:task-list":
+            self.emit("</ul>")
+        elif tag == "ac:task":
+            checked = " checked" if frame["status"] == "complete" else ""
+            self.emit(f"<li><input type='checkbox' disabled{checked}> {frame['body']}</li>")
+
+    # ---------- отрисовка ----------
+
+    def resource_url(self, resource):
+        kind, attrs = resource
+        if kind == "ri:page":
+            space = attrs.get("ri:space-key") or self.space_key
+            title = attrs.get("ri:content-title", "")
+            return f"{self.base_path}/display/{space}/{quote_plus(title)}"
+        if kind == "ri:attachment":
+            return f"{self.base_path}/download/attachments/{self.page_id}/{quote(attrs.get('ri:filename', ''))}"
+        return attrs.get("ri:value", "")
+
+    def render_link(self, frame):
+        anchor = frame["attrs"].get("ac:anchor")
+        resource = frame["resource"]
+        href = self.resource_url(resource) if resource else ""
+        if anchor:
+            href += "#" + quote(anchor)
+        body = frame["body"]
+        if not body:
+            if resource is None:
+                body = escape(anchor or "")
+            else:
+                kind, attrs = resource
+                body = escape(attrs.get("ri:content-title") or attrs.get("ri:filename") or attrs.get("ri:value", ""))
+        return f'<a href="{escape(href)}">{body}</a>'
+
+    def render_image(self, frame):
+        if frame["resource"] is None:
+            raise Unsupported("картинка без источника")
+        attrs = [f'src="{escape(self.resource_url(frame["resource"]))}"']
+        for name in ("width", "height", "alt", "title"):
+            value = frame["attrs"].get("ac:" + name)
+            if value:
+                attrs.append(f'{name}="{escape(value)}"')
+        return f"<img {' '.join(attrs)}>"
+
+    def render_macro(self, frame):
+        name = frame["name"]
+        params = frame["params"]
+        if name in CODE_MACROS:
+            language = f" class='{escape(params['language'])}'" if params.get("language") else ""
+            title = f"<div class='code-title'>{escape(params['title'])}</div>" if params.get("title") else ""
+            return f"<div class='code panel'>{title}<pre><code{language}>{frame['plain']}</code></pre></div>"
+        if name in PANELS:
+            title = f"<p class='panel-title'><b>{escape(params['title'])}</b></p>" if params.get("title") else ""
+            return f"<div class='confluence-{PANELS[name]}-macro'>{title}{frame['body']}</div>"
+        if name == "expand":
+            return f"<details><summary>{escape(params.get('title') or 'Подробнее')}</summary>{frame['body']}</details>"
+        if name == "anchor":
+            return f"<a name=\"{escape(params.get('', ''))}\"></a>"
+        self.toc = True
+        return TOC_MARKER
+
+    def result(self):
+        if self.frames:
+            raise Unsupported(f"незакрытый {self.frames[-1]['tag']}")
+        html = self.pop()
+        if self.toc:
+            html = add_toc(html)
+        return html
+
+
+def add_toc(html):
+    """Подставляет вместо TOC_MARKER оглавление по заголовкам страницы (заголовкам — id)."""
+    items = []
+
+    def number(m):
+        level, attrs, inner = m.groups()
+        anchor = re.search(r'id="([^"]*)"', attrs)
+        if anchor:
+            anchor = anchor.group(1)
+        else:
+            anchor = f"toc-{len(items) + 1}"
+            attrs += f' id="{anchor}"'
+        items.append((int(level), anchor, TAG_RE.sub("", inner)))
+        return f"<h{level}{attrs}>{inner}</h{level}>"
+
+    html = HEADING_RE.sub(number, html)
+    toc = "".join(f"<li style='margin-left:{(level - 1) * 15}px'><a href='#{anchor}'>{text}</a></li>"
+                  for level, anchor, text in items)
+    return html.replace(TOC_MARKER, f"<ul class='toc'>{toc}</ul>")
+
+
+def render_storage(storage, page_id, space_key, base_path="/wiki"):
+    """HTML по body.storage страницы или None, если в ней есть то, что отрисовать не умеем.
+
+    Вторым значением возвращается причина отказа (для сводки), при успехе — None.
+    """
+    renderer = StorageRenderer(page_id, space_key, base_path)
+    try:
+        renderer.feed(storage)
+        renderer.close()
+        return renderer.result(), None
+    except Unsupported as e:
+        return None, str(e)
@@ -0,0 +1,127 @@
+"""Превью картинок-вложений для <img> в тексте страниц.
+
+Снимки экрана и схемы в PNG весят мегабайты, а в тексте показываются в
+ширину колонки. Для каждой большой картинки пул процессов делает
+уменьшенную копию (WebP, если Pillow его умеет, иначе JPEG или PNG с
+прозрачностью) в export/_previews/<sha256>.<расширение>: одна копия на
+одинаковое содержимое, а index.json помнит, какие картинки уже
+обработаны, так что повторные выгрузки ничего не пережимают. В странице
+<img> показывает превью и ведёт ссылкой на оригинал.
+
+Pillow — необязательная зависимость: без него превью просто не делаются.
+"""
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from blob_store import file_sha256
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".tif", ".tiff", ".webp")
+MIN_BYTES = 100 * 1024  # картинки меньше (и не больше max_size по стороне) показываем как есть
+
+
+def available():
+    return Image is not None
+
+
+def make_preview(src, dest_base, max_size):
+    """Работает в процессе пула: уменьшает src до max_size по большей стороне.
+
+    Возвращает имя файла превью или "", если превью не нужно (картинка и так
+    маленькая, анимирована или уменьшенная копия вышла не легче оригинала).
+    """
+    with Image.open(src) as im:
+        if getattr(im, "is_animated", False):
+            return ""
+        if max(im.size) <= max_size and os.path.getsize(src) < MIN_BYTES:
+            return ""
+        im.thumbnail((max_size, max_size))
+        alpha = im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info
+        if features.check("webp"):
+            ext, fmt, options = ".webp", "WEBP", {"quality": 80, "method": 4}
+            im = im.convert("RGBA" if alpha else "RGB")
+        elif alpha:
+            ext, fmt, options = ".png", "PNG", {"optimize": True}
+            im = im.convert("RGBA")
+        else:
+            ext, fmt, options = ".jpg", "JPEG", {"quality": 85, "optimize": True}
+            im = im.convert("RGB")
+        dest = dest_base + ext
+        im.save(dest + ".tmp", fmt, **options)
+    if os.path.getsize(dest + ".tmp") >= os.path.getsize(src):
+        os.remove(dest + ".tmp")
+        return ""
+    os.replace(dest + ".tmp", dest)
+    return os.path.basename(dest)
+
+
+class Thumbnailer:
+    """Превью картинок в root (export/_previews), сделанные пулом процессов.
+
+    preview() можно звать из потоков выгрузки: одинаковая картинка с разных
+    страниц пережимается один раз, пока остальные ждут того же результата.
+    """
+
+    def __init__(self, root, max_size=1280, processes=None):
+        self.root = root
+        self.max_size = max_size
+        self.index_path = os.path.join(root, "index.json")
+        os.makedirs(root, exist_ok=True)
+        self.index = {}  # {sha256 оригинала: имя превью или ""}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                self.index = json.load(f)
+        # spawn, а не fork: процессы пул создаёт при первом submit из потоков выгрузки,
+        # и fork унаследовал бы захваченные ими блокировки
+        self.pool = ProcessPoolExecutor(max_workers=processes or os.cpu_count(),
+                                        mp_context=multiprocessing.get_context("spawn"))
+        self.lock = threading.Lock()
+        self.pending = {}  # {sha256: future}
+        self.made = 0
+        self.reused = 0
+        self.original_bytes = 0
+        self.preview_bytes = 0
+
+    def preview(self, path):
+        """Путь к превью картинки path или None (не картинка, маленькая или не открылась)."""
+        if not path.lower().endswith(IMAGE_EXTS) or not os.path.exists(path):
+            return None
+        digest = file_sha256(path)
+        with self.lock:
+            name = self.index.get(digest)
+            if name is not None and (not name or os.path.exists(os.path.join(self.root, name))):
+                self.reused += 1
+                return os.path.join(self.root, name) if name else None
+            future = self.pending.get(digest)
+            if future is None:
+                future = self.pool.submit(make_preview, path, os.path.join(self.root, digest), self.max_size)
+                self.pending[digest] = future
+        try:
+            name = future.result()
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            print(f"⚠️ Не удалось сделать превью {path}: {e}")
+            name = ""
+        with self.lock:
+            if self.pending.pop(digest, None) is not None and name:
+                self.made += 1
+                self.original_bytes += os.path.getsize(path)
+                self.preview_bytes += os.path.getsize(os.path.join(self.root, name))
+            self.index[digest] = name
+        return os.path.join(self.root, name) if name else None
+
+    def close(self):
+        self.pool.shutdown()
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+        mb = 1024 * 1024
+        print(f"Превью: сделано {self.made} ({self.original_bytes / mb:.1f} МБ -> {self.preview_bytes / mb:.1f} МБ), "
+              f"уже было {self.reused}")
@@ -1,97 +1,148 @@
 import argparse
 import os
-import time
+import threading
 import requests
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
 from urllib.parse import urljoin, urlparse
 
+from attachment_downloader import TransferPool, attachment_size, download_file, stream_file
+from blob_store import BlobStore
+from confluence_http import add_limiter_args, configure_limiter
+from export_archive import TREE_NAME, open_archive
+from html_rewrite import iter_rewrite
+from response_cache import add_cache_args, close_cache, configure_cache, get_json, is_offline
+from export_metrics import METRICS, add_metrics_args, report
+from page_tree import PageTree, common_prefix
+from path_allocator import PathAllocator, add_path_args, truncate_bytes
+from storage_render import render_storage
+
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Экспорт Confluence в HTML с вложениями и деревом навигации")
     parser.add_argument("base_url", help="Базовый URL Confluence")
     parser.add_argument("root_page_id", help="ID корневой страницы")
     parser.add_argument("output_dir", help="Директория для сохранения")
-    return parser.parse_args()
+    parser.add_argument("--workers", type=int, default=4, help="Сколько списков дочерних страниц запрашивать параллельно")
+    parser.add_argument("--download-workers", type=int, default=4, help="Сколько вложений качать параллельно")
+    parser.add_argument("--dedupe-attachments", action="store_true",
+                        help="Хранить вложения один раз по содержимому в <output_dir>/_blobs")
+    parser.add_argument("--archive",
+                        help="Писать в один архив (.zip, .tar или .sqlite) вместо каталога output_dir")
+    parser.add_argument("--local-render", action="store_true",
+                        help="Брать тела в body.storage и рисовать их здесь; body.view — только для страниц "
+                             "с макросами, которые локально не отрисовать")
+    add_path_args(parser)
+    add_limiter_args(parser)
+    add_cache_args(parser)
+    add_metrics_args(parser)
+    args = parser.parse_args(argv)
+    if args.archive and args.dedupe_attachments:
+        parser.error("--archive несовместим с --dedupe-attachments")
+    return args
+
+ATTACHMENT_NAME_BYTES = 200  # предел имени вложения на диске, байт UTF-8 (у файловой системы — 255)
+PATHS_FILE = "paths.json"  # карта id -> путь в output_dir, см. path_allocator
 
 def sanitize_filename(name):
-    max_length = 100
     safe_name = "".join(c if c.isalnum() or c in " .-_()" else "_" for c in name).strip()
-    if len(safe_name) > max_length:
+    if len(safe_name.encode("utf-8")) > ATTACHMENT_NAME_BYTES:
         base, ext = os.path.splitext(safe_name)
-        safe_name = base[:max_length - len(ext)] + ext
+        safe_name = truncate_bytes(base, ATTACHMENT_NAME_BYTES - len(ext.encode("utf-8"))) + ext
     return safe_name
 
-def retry_get(session, url, max_retries=5, delay=1):
-    for attempt in range(max_retries):
-        r = session.get(url)
-        if r.status_code == 429:
-            retry_after = int(r.headers.get("Retry-After", delay))
-            print(f"⚠️ 429 Too Many Requests. Waiting {retry_after} seconds...")
-            time.sleep(retry_after)
-            continue
-        if r.status_code == 404:
-            return None
-        r.raise_for_status()
-        return r
-    raise Exception("Failed after retries")
+def fetch_page(session, base_url, page_id, representation="view"):
+    url = f"{base_url}/rest/api/content/{page_id}?expand=body.{representation},title,space"
+    return get_json(session, url)
 
-def fetch_page(session, base_url, page_id):
-    url = f"{base_url}/rest/api/content/{page_id}?expand=body.view,title"
-    r = retry_get(session, url)
-    return r.json() if r else None
-
-def fetch_children(session, base_url, page_id):
-    url = f"{base_url}/rest/api/content/{page_id}/child/page?limit=100"
-    r = retry_get(session, url)
-    return r.json().get("results", []) if r else []
+def fetch_children(session, base_url, page_id, representation="view"):
+    """Все дочерние страницы сразу с телами (expand=body.view или body.storage), с учётом постраничной выдачи."""
+    children = []
+    start = 0
+    limit = 100
+    while True:
+        url = (f"{base_url}/rest/api/content/{page_id}/child/page?limit={limit}&start={start}"
+               f"&expand=body.{representation},space")
+        data = get_json(session, url)
+        if not data:
+            break
+        results = data.get("results", [])
+        children.extend(results)
+        if not results or "next" not in data.get("_links", {}):
+            break
+        # с телами Confluence может урезать окно ниже limit — шагаем на то, что пришло
+        start += len(results)
+    return children
 
 def fetch_attachments(session, base_url, page_id):
-    url = f"{base_url}/rest/api/content/{page_id}/child/attachment?limit=1000"
-    r = retry_get(session, url)
-    return r.json().get("results", []) if r else []
+    url = f"{base_url}/rest/api/content/{page_id}/child/attachment?limit=1000&expand=version"
+    data = get_json(session, url)
+    return data.get("results", []) if data else []
 
-def download_attachment(session, url, save_path):
+def download_attachment(session, url, save_path, expected_size=None, version=None):
+    if is_offline() and os.path.exists(save_path):
+        return True  # --offline: вложение осталось от прошлой выгрузки
     try:
-        r = retry_get(session, url)
-        if not r:
+        if download_file(session, url, save_path, expected_size, version) is None:
             print(f"⚠️ Attachment not found (404): {url}")
             return
-        with open(save_path, "wb") as f:
-            for chunk in r.iter_content(1024):
-                f.write(chunk)
+        return True
     except requests.RequestException as e:
         print(f"⚠️ Failed to download {url}: {e}")
 
 def rewrite_html_links(html, attachments_dir):
-    soup = BeautifulSoup(html, "html.parser")
-    for img in soup.find_all("img"):
-        src = img.get("src")
-        if src:
-            filename = os.path.basename(urlparse(src).path)
-            img["src"] = f"{attachments_dir}/{filename}"
-    for a in soup.find_all("a"):
-        href = a.get("href")
-        if href and urlparse(href).scheme in ["http", "https"]:
-            filename = os.path.basename(urlparse(href).path)
-            a["href"] = f"{attachments_dir}/{filename}"
-    return str(soup)
-
-def build_sidebar_html(tree, current_path):
-    def recurse(node, current_path):
-        rel_path = node["path"]
-        title = node["title"]
-        href = os.path.relpath(rel_path, os.path.dirname(current_path))
-        is_current = (rel_path == current_path)
-        current_marker = ' class="current"' if is_current else ""
-        children_html = "\n".join(recurse(child, current_path) for child in node.get("children", []))
-        return f"<li{current_marker}><a href=\"{href}\">{title}</a>{f'<ul>{children_html}</ul>' if children_html else ''}</li>"
-    return f"<ul>{recurse(tree, current_path)}</ul>"
-
-def build_html_page(title, content_html, current_node, output_dir, full_tree_root):
-    sidebar = build_sidebar_html(full_tree_root, current_node["path"])
-    return f"""<!DOCTYPE html>
+    """Итератор кусков html со ссылками картинок и внешних ссылок на attachments_dir (без разбора в дерево)."""
+    def rewrite(tag, attr, val):
+        if not val:
+            return None
+        if tag == "img" and attr == "src":
+            return f"{attachments_dir}/{os.path.basename(urlparse(val).path)}"
+        if tag == "a" and attr == "href" and urlparse(val).scheme in ["http", "https"]:
+            return f"{attachments_dir}/{os.path.basename(urlparse(val).path)}"
+        return None
+
+    return iter_rewrite(html, rewrite)
+
+def sidebar_tree(root):
+    """PageTree по дереву build_tree: путь узла — каталог его страницы."""
+    pages = PageTree()
+    stack = [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        i = pages.add(node["id"], node["title"], parent, path=tuple(os.path.dirname(node["path"]).split(os.sep)))
+        stack.extend((child, i) for child in reversed(node["children"]))
+    return pages
+
+def build_sidebar_html(pages, current):
+    """Меню со ссылками относительно каталога страницы current (номер узла в pages).
+
+    Сколько первых каталогов пункта совпадает с каталогом текущей страницы,
+    узнаётся от родителя за O(1) — без os.path.relpath на каждый пункт меню.
+    Только для страниц, перенесённых из-за длины пути, оно считается заново.
+    """
+    here = pages.path(current)
+
+    def recurse(i, parent_parts, common):
+        parts = pages.path(i)
+        if parts[:-1] != parent_parts:
+            common = common_prefix(parts, here)
+        elif common == len(parent_parts) and common < len(here) and here[common] == parts[-1]:
+            common += 1
+        href = os.sep.join((os.pardir,) * (len(here) - common) + parts[common:] + ("index.html",))
+        current_marker = ' class="current"' if i == current else ""
+        children_html = "\n".join(recurse(child, parts, common) for child in pages.children[i])
+        return f"<li{current_marker}><a href=\"{href}\">{pages.title[i]}</a>{f'<ul>{children_html}</ul>' if children_html else ''}</li>"
+    return f"<ul>{''.join(recurse(root, (), 0) for root in pages.roots)}</ul>"
+
+CONTENT_MARKER = "\x01"  # место тела страницы в шаблоне
+
+def build_html_page(title, content_chunks, current_node, output_dir, menu):
+    """Страница кусками: шапка с меню (menu — sidebar_tree всего дерева), куски тела, хвост."""
+    sidebar = build_sidebar_html(menu, menu.index[current_node["id"]])
+    head, tail = f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset=\"UTF-8\">
@@ -108,66 +159,204 @@ def build_html_page(title, content_html, current_node, output_dir, full_tree_roo
 </head>
 <body>
     <nav>{sidebar}</nav>
-    <main><h1>{title}</h1>{content_html}</main>
+    <main><h1>{title}</h1>{CONTENT_MARKER}</main>
 </body>
-</html>"""
+</html>""".split(CONTENT_MARKER)
+    return chain((head,), content_chunks, (tail,))
 
-def build_tree(session, base_url, page_id, output_dir, rel_path=""):
-    page = fetch_page(session, base_url, page_id)
-    if not page:
-        return None
-    title = page["title"]
-    sanitized = sanitize_filename(title)
-    page_rel_path = os.path.join(rel_path, sanitized)
-    children = fetch_children(session, base_url, page_id)
-    child_nodes = [
-        build_tree(session, base_url, child["id"], output_dir, rel_path=page_rel_path)
-        for child in children
-    ]
+def make_node(page, path):
+    """Узел дерева; path — сегменты каталога страницы от PathAllocator."""
     return {
-        "id": page_id,
-        "title": title,
-        "path": os.path.join(page_rel_path, "index.html"),
-        "children": [c for c in child_nodes if c]
+        "id": page["id"],
+        "title": page["title"],
+        "path": os.path.join(*path, "index.html"),
+        "children": []
     }
 
-def render_tree(session, base_url, node, output_dir, full_tree_root):
-    page = fetch_page(session, base_url, node["id"])
+RENDER_STATS = {"local": 0, "view": 0}  # --local-render: сколько страниц отрисовано здесь, сколько взято в body.view
+_render_lock = threading.Lock()
+
+def page_body(session, base_url, page, local_render=False):
+    """HTML тела страницы: body.view как есть или body.storage, отрисованный storage_render.
+
+    Страница, в которой есть то, что локально не отрисовать, перезапрашивается в body.view.
+    """
+    if not local_render:
+        return page["body"]["view"]["value"]
+    space_key = page.get("space", {}).get("key", "")
+    with METRICS.phase("storage_render"):
+        html, _ = render_storage(page["body"]["storage"]["value"], page["id"], space_key, urlparse(base_url).path)
+    with _render_lock:
+        RENDER_STATS["local" if html is not None else "view"] += 1
+    if html is not None:
+        return html
+    data = fetch_page(session, base_url, page["id"])
+    return data["body"]["view"]["value"] if data else ""
+
+def children_with_bodies(session, base_url, page_id, local_render=False):
+    """Дети страницы вместе с готовыми HTML их тел: [(страница, html)]."""
+    representation = "storage" if local_render else "view"
+    return [(child, page_body(session, base_url, child, local_render))
+            for child in fetch_children(session, base_url, page_id, representation)]
+
+def build_tree(session, base_url, page_id, bodies, allocator, workers=4, local_render=False):
+    """Строит дерево за один проход.
+
+    Тело каждой страницы приходит вместе со списком детей её родителя и
+    складывается в bodies (id -> html), так что render_tree больше ничего
+    не запрашивает. Дети всех узлов одного уровня запрашиваются параллельно.
+    Пути детям одного родителя allocator раздаёт сразу всем — одноимённые
+    страницы не попадают в один каталог.
+    """
+    page = fetch_page(session, base_url, page_id, "storage" if local_render else "view")
     if not page:
-        return
-    title = page["title"]
+        return None
+    root = make_node(page, allocator.place(None, [(page["id"], page["title"])])[0])
+    bodies[root["id"]] = page_body(session, base_url, page, local_render)
+
+    level = [root]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while level:
+            next_level = []
+            all_children = pool.map(
+                lambda n: children_with_bodies(worker_session(), base_url, n["id"], local_render), level)
+            for node, children in zip(level, all_children):
+                paths = allocator.place(node["id"], [(child["id"], child["title"]) for child, _ in children])
+                for (child, html), path in zip(children, paths):
+                    child_node = make_node(child, path)
+                    bodies[child_node["id"]] = html
+                    node["children"].append(child_node)
+                    next_level.append(child_node)
+            level = next_level
+    return root
+
+def archive_attachment(session, url, name, archive, expected_size=None):
+    entry = archive.open(name)
+    if entry is None:
+        return  # уже в архиве
+    try:
+        with entry:
+            if stream_file(session, url, entry, expected_size) is None:
+                entry.discard()
+                print(f"⚠️ Attachment not found (404): {url}")
+    except requests.RequestException as e:
+        print(f"⚠️ Failed to download {url}: {e}")
+
+def save_attachment(session, download_link, save_path, expected_size=None, store=None, key=None, archive=None,
+                    name=None, version=None):
+    if archive is not None:
+        archive_attachment(session, download_link, name, archive, expected_size)
+    elif store is None:
+        download_attachment(session, download_link, save_path, expected_size, version)
+    else:
+        store.fetch(key, lambda tmp: download_attachment(session, download_link, tmp, expected_size, version),
+                    save_path)
+
+def render_tree(session, base_url, node, output_dir, menu, bodies, store=None, transfers=None, archive=None,
+                parent_id=None):
+    title = node["title"]
     page_dir = os.path.join(output_dir, os.path.dirname(node["path"]))
-    page_dir = page_dir.replace(' ', '')
-    os.makedirs(page_dir, exist_ok=True)
-    attachments = fetch_attachments(session, base_url, node["id"])
+    # в архиве имена идут относительно output_dir
+    archive_dir = os.path.dirname(node["path"]) if archive is not None else None
+    if archive is None:
+        os.makedirs(page_dir, exist_ok=True)
+    with METRICS.phase("attachment_list"):
+        attachments = fetch_attachments(session, base_url, node["id"])
     attachments_dir = os.path.join(page_dir, "attachments")
-    os.makedirs(attachments_dir, exist_ok=True)
+    if archive is None:
+        os.makedirs(attachments_dir, exist_ok=True)
+    jobs = []
     for att in attachments:
         download_link = f"{base_url}{att['_links']['download']}"
         filename = sanitize_filename(att["title"])
         save_path = os.path.join(attachments_dir, filename)
-        download_attachment(session, download_link, save_path)
-    html = page["body"]["view"]["value"]
-    fixed_html = rewrite_html_links(html, "attachments")
-    full_html = build_html_page(title, fixed_html, node, output_dir, full_tree_root)
-    with open(os.path.join(page_dir, "index.html"), "w", encoding="utf-8") as f:
-        f.write(full_html)
+        version = att.get("version", {}).get("number")
+        key = f"{att['id']}:{version}" if version is not None else None
+        name = os.path.join(archive_dir, "attachments", filename) if archive is not None else None
+        jobs.append(partial(save_attachment, download_link=download_link, save_path=save_path,
+                            expected_size=attachment_size(att), store=store, key=key, archive=archive, name=name,
+                            version=version))
+    with METRICS.phase("attachments"):
+        if transfers is None:
+            for job in jobs:
+                job(session)
+        else:
+            transfers.run(jobs)
+    html = bodies.pop(node["id"])
+    with METRICS.phase("build_menu_html"):
+        chunks = build_html_page(title, rewrite_html_links(html, "attachments"), node, output_dir, menu)
+    # ссылки переписываются потоком прямо при записи страницы: время выдачи кусков —
+    # rewrite_links, сама запись — write
+    with METRICS.streamed_phase("write", "rewrite_links", chunks) as chunks:
+        if archive is not None:
+            name = os.path.join(archive_dir, "index.html")
+            archive.write_bytes(name, (chunk.encode("utf-8") for chunk in chunks))
+            archive.add_page(node["id"], title, parent_id, name)
+        else:
+            with open(os.path.join(page_dir, "index.html"), "w", encoding="utf-8") as f:
+                f.writelines(chunks)
     for child in node.get("children", []):
-        render_tree(session, base_url, child, output_dir, full_tree_root)
+        render_tree(session, base_url, child, output_dir, menu, bodies, store, transfers, archive,
+                    node["id"])
+
+SHARED_SESSION = None  # пакетный режим (batch_export.py): одна сессия на все потоки
 
 def get_session():
+    if SHARED_SESSION is not None:
+        return SHARED_SESSION
     s = requests.Session()
     s.auth = (os.environ['UNAME'], os.environ['PASSWD'])
     s.verify = False
     s.cert = os.environ['CERT_PATH']
+    s.headers.update({"Accept": "application/json"})
     return s
 
+_local = threading.local()
+
+def worker_session():
+    """Своя сессия на каждый поток пула."""
+    if not hasattr(_local, "session"):
+        _local.session = get_session()
+    return _local.session
+
+def export_root(args):
+    """Выгружает дерево от args.root_page_id в args.output_dir (или в args.archive); возвращает дерево."""
+    session = get_session()
+    bodies = {}
+    # к каталогу страницы дописываются /index.html и /attachments/<имя вложения>
+    allocator = PathAllocator(None if args.archive else os.path.join(args.output_dir, PATHS_FILE),
+                              args.max_name_bytes, args.max_path_bytes, args.flat_paths,
+                              len(os.path.join("", "attachments", "")) + ATTACHMENT_NAME_BYTES,
+                              (PATHS_FILE, "_blobs", TREE_NAME))
+    with METRICS.phase("listing"):
+        tree = build_tree(session, args.base_url, args.root_page_id, bodies, allocator, args.workers,
+                          args.local_render)
+    allocator.save()
+    allocator.report()
+    if args.local_render:
+        print(f"Отрисовано локально: {RENDER_STATS['local']}, взято в body.view: {RENDER_STATS['view']}")
+    store = BlobStore(os.path.join(args.output_dir, "_blobs")) if args.dedupe_attachments else None
+    transfers = TransferPool(get_session, args.download_workers) if args.download_workers > 1 else None
+    archive = open_archive(args.archive) if args.archive else None
+    render_tree(session, args.base_url, tree, args.output_dir, menu=sidebar_tree(tree), bodies=bodies,
+                store=store, transfers=transfers, archive=archive)
+    if transfers is not None:
+        transfers.shutdown()
+    if archive is not None:
+        archive.close()
+    if store is not None:
+        store.save()
+        store.report()
+    return tree
+
 def main():
     args = parse_args()
-    session = get_session()
-    session.headers.update({"Accept": "application/json"})
-    tree = build_tree(session, args.base_url, args.root_page_id, args.output_dir)
-    render_tree(session, args.base_url, tree, args.output_dir, full_tree_root=tree)
+    limiter = configure_limiter(args)
+    configure_cache(args)
+    export_root(args)
+    close_cache()
+    report(args, exporter="wiki_saver", root_page_id=args.root_page_id)
+    limiter.print_summary()
 
 if __name__ == "__main__":
     main()